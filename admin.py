@@ -1,7 +1,10 @@
+from datetime import datetime
+
 from flask import redirect
 from flask_admin import Admin, AdminIndexView
 from flask_admin.contrib.sqla import ModelView
 from flask_login import current_user
+from sql.partitions import add_months
 
 from models import (
     EmailInvite,
@@ -29,13 +32,28 @@ class MyAdminIndexView(AdminIndexView):
             return redirect("/login")
 
 
+class TaskView(ModelView):
+    # tasks is partitioned by month. Only look at this month and the last one so postgres can skip the rest
+    column_default_sort = ("started_at", True)
+
+    def _recent(self, query):
+        since = add_months(datetime.now().date(), -1)
+        return query.filter(Task.started_at >= since)
+
+    def get_query(self):
+        return self._recent(super().get_query())
+
+    def get_count_query(self):
+        return self._recent(super().get_count_query())
+
+
 def register(app, db):
     admin = Admin(app, index_view=MyAdminIndexView())
     admin.add_view(ModelView(User, db.session))
     admin.add_view(ModelView(GroupsAndUsersAssociation, db.session))
     admin.add_view(ModelView(Group, db.session))
     admin.add_view(ModelView(Pair, db.session))
-    admin.add_view(ModelView(Task, db.session))
+    admin.add_view(TaskView(Task, db.session))
     admin.add_view(ModelView(EmailInvite, db.session))
     admin.add_view(ModelView(PasswordReset, db.session))
     admin.add_view(ModelView(GroupPairReveals, db.session))
@@ -3,13 +3,25 @@ import os
 import re
 import urllib.parse
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
 from random import choices
+from uuid import UUID
 
 import maya
 import sentry_sdk
 from celery import Celery
-from flask import Flask, flash, jsonify, redirect, render_template, request, url_for
+from flask import (
+    Flask,
+    Response,
+    abort,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask_bootstrap import Bootstrap
 from flask_login import (
     LoginManager,
@@ -37,6 +49,7 @@ from forms import (
     ResetPasswordForm,
     SignUpForm,
 )
+from lib.chat.stream import ChatStream
 from lib.oauth.google import Google
 from models import (
     EmailInvite,
@@ -45,15 +58,15 @@ from models import (
     GroupPairReveals,
     GroupsAndUsersAssociation,
     Issue,
+    LatestPair,
     Message,
     OAuthProviderEnum,
     Pair,
-    PairCreationStatus,
     Task,
     User,
     UserOAuthProfile,
     all_admin_materialized_view,
-    all_latest_pairs_view,
+    avatar_url,
     db,
 )
 from serializers import ma
@@ -87,7 +100,8 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 csrf.init_app(app)
 
-celery = Celery("tasks", broker=os.environ.get("CELERY_BROKER_URL"))
+celery = Celery("tasks")
+celery.config_from_object("celery_config")
 
 if os.getenv("ENV") == "production":
     logger = logging.getLogger("gunicorn.error")
@@ -113,6 +127,17 @@ if os.getenv("ENV") == "production":
         },
     )
 
+# How many chat messages one GET returns at most. The chat modals load the newest page and
+# then only ask for what came after it
+CHAT_PAGE_SIZE = 50
+
+# A draw that has been starting/processing for longer than this lost its worker somewhere along the way. It
+# shouldn't keep the group from drawing again
+DRAW_STALE_AFTER = timedelta(minutes=15)
+
+# New chat messages are pushed to open chats through redis, see app.chat_stream
+chat_stream = ChatStream(broker_url=os.environ.get("CELERY_BROKER_URL"))
+
 OAUTH_CLIENTS = {
     "google": Google(
         client_id=os.getenv("GOOGLE_CLIENT_ID"),
@@ -210,12 +235,8 @@ def reset_password():
         email = form.email.data
         user = User.query.filter_by(email=email).first()
         if user:
-            currently_running_reset_attempt = Task.query.filter(
-                and_(
-                    Task.payload["email"].as_string() == user.email,
-                    Task.name == "reset_user_password",
-                    Task.status == "starting",
-                )
+            currently_running_reset_attempt = Task.find(
+                "reset_user_password", status="starting", email=user.email
             ).first()
 
             if currently_running_reset_attempt:
@@ -224,12 +245,8 @@ def reset_password():
                     "reset_password.html", form=form, message=message
                 )
 
-            password_reset_attempts = Task.query.filter(
-                and_(
-                    Task.payload["email"].as_string() == user.email,
-                    Task.name == "reset_user_password",
-                    Task.status == "finished",
-                )
+            password_reset_attempts = Task.find(
+                "reset_user_password", status="finished", email=user.email
             ).all()
             if len(password_reset_attempts) < 3:
                 with AdvisoryLock(
@@ -245,34 +262,23 @@ def reset_password():
                             started_at=datetime.now(),
                             status="starting",
                         )
-                        session.add(new_attempt)
+                        new_attempt.enqueue(session, "user.reset_password")
 
                     else:
                         message = "Too many reset attempts at the same time!"
                         return render_template(
                             "/reset_password", form=form, message=message
                         )
-                # Send task to celery ONLY AFTER we have
-                # 1. Committed the new row to db
-                # 2. Released the lock
-
-                celery.send_task("user.reset_password", (user.email,))
+                # The task row and its outbox message were committed together when we
+                # released the lock. The outbox relay takes it from here
 
                 message = f"A temporary password will be sent to {user.email} shortly"
                 return render_template(
                     "reset_password.html", form=form, message=message
                 )
             else:
-                last_reset_attempt_date = (
-                    Task.query.with_entities(func.max(Task.started_at))
-                    .filter(
-                        and_(
-                            Task.payload["email"].as_string() == user.email,
-                            Task.name == "reset_user_password",
-                            Task.status == "finished",
-                        )
-                    )
-                    .first()[0]
+                last_reset_attempt_date = max(
+                    attempt.started_at for attempt in password_reset_attempts
                 )
                 today = datetime.now()
 
@@ -291,27 +297,21 @@ def reset_password():
                         lock, session = locked_session
                         if lock:
                             new_attempt = Task(
+                                name="reset_user_password",
                                 payload={
-                                    "name": "reset_user_password",
                                     "email": user.email,
                                 },
                                 started_at=datetime.now(),
                                 status="starting",
                             )
 
-                            session.add(new_attempt)
+                            new_attempt.enqueue(session, "user.reset_password")
                         else:
                             message = "Too many reset attempts at the same time!"
                             return render_template(
                                 "reset_password", form=form, message=message
                             )
 
-                    # Send task to celery ONLY AFTER we have
-                    # 1. Committed the new row to db
-                    # 2. Released the lock
-
-                    celery.send_task("user.reset_password", (user.email,))
-
                     message = (
                         f"A temporary password will be sent to {user.email} shortly"
                     )
@@ -366,7 +366,7 @@ def profile(username=None):
     if username:
         user = User.query.filter_by(username=username).first()
         # Only reveal profile info if the current user is the secret santa of this username in some group
-        secret_santees = all_latest_pairs_view.query.filter_by(
+        secret_santees = LatestPair.query.filter_by(
             giver_username=current_user.username
         ).all()
 
@@ -407,10 +407,10 @@ def kick():
 @app.route("/santa", methods=["GET", "POST"])
 @login_required
 def santa():
-    all_pairs = all_latest_pairs_view.query.filter(
+    all_pairs = LatestPair.query.filter(
         or_(
-            all_latest_pairs_view._view.giver_username == current_user.username,
-            all_latest_pairs_view._view.receiver_username == current_user.username,
+            LatestPair.giver_username == current_user.username,
+            LatestPair.receiver_username == current_user.username,
         )
     ).all()
 
@@ -464,8 +464,8 @@ def group():
             )
             new_group_assoc.save_to_db(db)
 
-            # TODO: @prithajnath
-            # We shouldn't have to do this here. This should be taken care of by the right SQLALchemy hook
+            # The hook only schedules a refresh for later, but we're about to redirect to a page
+            # that checks if this user is the admin. So refresh now and wait
             all_admin_materialized_view.refresh()
 
             return redirect(url_for(".group", group_id=new_group.id))
@@ -494,9 +494,13 @@ def group():
             logger.info(f"Creating pairs for {group_id}")
             group = Group.query.filter_by(id=group_id).first()
 
-            currently_running_creation_attempt = PairCreationStatus.query.filter_by(
-                group_id=group.id, status="creating"
-            ).first()
+            currently_running_creation_attempt = (
+                Task.find(
+                    "create_pairs", status=("starting", "processing"), group_id=group.id
+                )
+                .filter(Task.started_at > datetime.now() - DRAW_STALE_AFTER)
+                .first()
+            )
 
             if currently_running_creation_attempt:
                 message = "Pair creation already in progress"
@@ -528,7 +532,7 @@ def group():
                                 status="starting",
                             )
 
-                            session.add(creation_attempt)
+                            creation_attempt.enqueue(session, "pair.create_pairs")
                         else:
                             message = (
                                 "Too many attempts to create pairs at the same time!"
@@ -537,15 +541,11 @@ def group():
                                 url_for(".group", message=message, group_id=group_id)
                             )
 
-                    # Again, only queue messages after lock has been released
-                    task = celery.send_task("pair.create_pairs", (group_id,))
-
-                    if task.status == "PENDING":
-                        timestamp = maya.MayaDT.from_datetime(datetime.now())
-                        message = f"Pair creation has been initiated at {timestamp.__str__()}. Sit tight!"
-                        return redirect(
-                            url_for(".group", message=message, group_id=group_id)
-                        )
+                    timestamp = maya.MayaDT.from_datetime(datetime.now())
+                    message = f"Pair creation has been initiated at {timestamp.__str__()}. Sit tight!"
+                    return redirect(
+                        url_for(".group", message=message, group_id=group_id)
+                    )
             else:
                 message = "This group is in cooldown (Pairs were created recently). Please try again in a day"
                 return redirect(url_for(".group", message=message, group_id=group_id))
@@ -570,7 +570,7 @@ def group():
                 ),
             )
 
-            new_invite.save_to_db(db)
+            db.session.add(new_invite)
 
             to_email = new_invite.invited_email
             admin_first_name = current_user.first_name
@@ -589,23 +589,23 @@ def group():
                     },
                 )
 
-                _task.save_to_db(db)
-
-                task = celery.send_task(
+                # The invite, its task and the outbox message all go in one commit
+                _task.enqueue(
+                    db.session,
                     "user.invite_user_to_sign_up",
-                    (to_email, admin_first_name, group_name),
+                    idempotency_key=f"invite:{new_invite.code}",
                 )
+                db.session.commit()
 
-                if task.status == "PENDING":
-                    return redirect(
-                        url_for(
-                            ".group",
-                            message=f"{invite_user_to_group_form.email.data} has been invited to create an account and join this group!",
-                            group_id=group_id,
-                            create_pairs_form=create_pairs_form,
-                            form=invite_user_to_group_form,
-                        )
+                return redirect(
+                    url_for(
+                        ".group",
+                        message=f"{invite_user_to_group_form.email.data} has been invited to create an account and join this group!",
+                        group_id=group_id,
+                        create_pairs_form=create_pairs_form,
+                        form=invite_user_to_group_form,
                     )
+                )
 
             else:
                 _task = Task(
@@ -620,23 +620,23 @@ def group():
                     },
                 )
 
-                _task.save_to_db(db)
-
-                task = celery.send_task(
+                # The invite, its task and the outbox message all go in one commit
+                _task.enqueue(
+                    db.session,
                     "user.invite_user_to_group",
-                    (to_email, admin_first_name, group_name),
+                    idempotency_key=f"invite:{new_invite.code}",
                 )
+                db.session.commit()
 
-                if task.status == "PENDING":
-                    return redirect(
-                        url_for(
-                            ".group",
-                            message=f"{invite_user_to_group_form.email.data} has been invited to join this group!",
-                            group_id=group_id,
-                            create_pairs_form=create_pairs_form,
-                            form=invite_user_to_group_form,
-                        )
+                return redirect(
+                    url_for(
+                        ".group",
+                        message=f"{invite_user_to_group_form.email.data} has been invited to join this group!",
+                        group_id=group_id,
+                        create_pairs_form=create_pairs_form,
+                        form=invite_user_to_group_form,
                     )
+                )
 
     group_id = request.args.get("group_id")
     message = request.args.get("message")
@@ -851,6 +851,20 @@ def signup():
 # JSON endpoints
 
 
+def _group_message_json(id, username, first_name, text, created_at, sender_id):
+    # What both the chat history and the chat stream send for a group message. "type" depends
+    # on who's looking, so the history adds it and the browser works it out for streamed ones
+    return {
+        "id": id,
+        "username": username,
+        "avatar_url": avatar_url(username),
+        "first_name": first_name,
+        "text": text,
+        "created_at": created_at.isoformat() if created_at else None,
+        "sender_id": sender_id,
+    }
+
+
 @app.route("/group_message", methods=["GET", "POST"])
 @login_required
 def group_message():
@@ -872,7 +886,8 @@ def group_message():
             created_at=datetime.now(),
         )
 
-        new_message.save_to_db(db)
+        db.session.add(new_message)
+        db.session.flush()
 
         if last_message:
             delta = new_message.created_at - last_message.created_at
@@ -892,159 +907,204 @@ def group_message():
                 },
             )
 
-            task.save_to_db(db)
-
-            celery.send_task(
+            task.enqueue(
+                db.session,
                 "user.send_group_chat_notifications",
-                (current_user.username, message, group_id),
+                idempotency_key=f"group_message:{new_message.id}",
             )
         else:
             logger.info(f"Too many frquent messages for group {group_id}. Backing off")
 
-        return jsonify(result=True)
+        # The message and its notification (if any) are committed together
+        db.session.commit()
+
+        chat_stream.publish(
+            chat_stream.channel("group", group_id),
+            _group_message_json(
+                new_message.id,
+                current_user.username,
+                current_user.first_name,
+                new_message.text,
+                new_message.created_at,
+                current_user.id,
+            ),
+        )
+
+        return jsonify(result=True, id=new_message.id)
 
-    all_messages = (
-        GroupMessage.query.filter_by(group_id=group_id)
-        .order_by(GroupMessage.created_at)
-        .all()
+    # ?after=<id> returns what was posted since the client last looked, ?before=<id> the page
+    # before the oldest message it has. With neither we return the newest page
+    after = request.args.get("after", type=int)
+    messages, more = GroupMessage.page(
+        GroupMessage.history(group_id),
+        after=after,
+        before=request.args.get("before", type=int),
+        limit=CHAT_PAGE_SIZE,
     )
 
     return jsonify(
+        after=messages[-1].id if messages else after,
+        before=messages[0].id if messages else None,
+        more=more,
         result=[
             {
-                "username": message.sender.username,
-                "avatar_url": message.sender.avatar_url,
-                "first_name": message.sender.first_name,
+                **_group_message_json(**message._asdict()),
                 "type": (
-                    "receiver"
-                    if current_user.username == message.sender.username
-                    else "sender"
+                    "receiver" if message.sender_id == current_user.id else "sender"
                 ),
-                "text": message.text,
             }
-            for message in all_messages
-        ]
+            for message in messages
+        ],
     )
 
 
-@app.route("/santee_message", methods=["GET", "POST"])
-@login_required
-def santee_message():
-    to = request.args.get("to")
-    channel_id = request.args.get("channel_id")
+def _private_channel(channel_id, as_giver=None):
+    # Returns the channel and the id of whoever is on the other end of it. 404s for channels
+    # that don't exist and for users who aren't on the expected side of the pair (either side
+    # when as_giver is None)
+    try:
+        channel_id = UUID(channel_id)
+        giver_id, receiver_id = Pair.participants(channel_id)
+    except (TypeError, ValueError, LookupError):
+        abort(404)
 
-    santee = User.query.filter_by(username=to).first()
+    if as_giver is None:
+        as_giver = current_user.id == giver_id
 
-    if request.method == "POST":
-        message = request.json.get("message")
-        new_message = Message(
-            sender_id=current_user.id,
-            receiver_id=santee.id,
-            pair_channel_id=channel_id,
-            text=message,
-            created_at=datetime.now(),
-        )
+    if current_user.id != (giver_id if as_giver else receiver_id):
+        abort(404)
 
-        new_message.save_to_db(db)
-
-        _task = Task(
-            name="send_message_notification",
-            started_at=datetime.now(),
-            status="starting",
-            payload={
-                "sender_id": current_user.id,
-                "receiver_id": santee.id,
-                "channel_id": channel_id,
-                "text": message,
-            },
-        )
+    return channel_id, (receiver_id if as_giver else giver_id)
 
-        _task.save_to_db(db)
 
-        celery.send_task(
-            "user.send_message_notification",
-            (current_user.id, santee.id, channel_id, message, True),
-        )
+def _send_private_message(channel_id, receiver_id, anonymous):
+    message = request.json.get("message")
+    new_message = Message(
+        sender_id=current_user.id,
+        receiver_id=receiver_id,
+        pair_channel_id=channel_id,
+        text=message,
+        created_at=datetime.now(),
+    )
+
+    db.session.add(new_message)
+    db.session.flush()
+
+    _task = Task(
+        name="send_message_notification",
+        started_at=datetime.now(),
+        status="starting",
+        payload={
+            "sender_id": current_user.id,
+            "receiver_id": receiver_id,
+            "channel_id": str(channel_id),
+            "text": message,
+            "anonymous": anonymous,
+        },
+    )
+
+    _task.enqueue(
+        db.session,
+        "user.send_message_notification",
+        idempotency_key=f"message:{new_message.id}",
+    )
+    db.session.commit()
+
+    chat_stream.publish(
+        chat_stream.channel("pair", channel_id),
+        _private_message_json(new_message, Pair.participants(channel_id)[0]),
+    )
 
-        return jsonify(result=True)
+    return jsonify(result=True, id=new_message.id)
 
-    messages = (
-        Message.query.filter_by(pair_channel_id=channel_id)
-        .order_by(Message.created_at)
-        .all()
+
+def _private_message_json(message, giver_id):
+    # Santa chats are anonymous, so streamed messages only say which side of the pair sent them
+    # and never who that is
+    return {
+        "id": message.id,
+        "from_giver": message.sender_id == giver_id,
+        "text": message.text,
+    }
+
+
+def _private_messages(channel_id):
+    # Same cursors as app.group_message
+    after = request.args.get("after", type=int)
+    messages, more = Message.page(
+        Message.query.filter_by(pair_channel_id=channel_id),
+        after=after,
+        before=request.args.get("before", type=int),
+        limit=CHAT_PAGE_SIZE,
     )
+    giver_id, _ = Pair.participants(channel_id)
 
     return jsonify(
+        after=messages[-1].id if messages else after,
+        before=messages[0].id if messages else None,
+        more=more,
         result=[
-            (
-                "receiver" if message.sender_id == current_user.id else "sender",
-                message.text,
-            )
+            {
+                **_private_message_json(message, giver_id),
+                "type": (
+                    "receiver" if message.sender_id == current_user.id else "sender"
+                ),
+            }
             for message in messages
-        ]
+        ],
     )
 
 
+@app.route("/santee_message", methods=["GET", "POST"])
+@login_required
+def santee_message():
+    channel_id, santee_id = _private_channel(
+        request.args.get("channel_id"), as_giver=True
+    )
+
+    if request.method == "POST":
+        return _send_private_message(channel_id, santee_id, anonymous=True)
+
+    return _private_messages(channel_id)
+
+
 @app.route("/santa_message", methods=["GET", "POST"])
 @login_required
 def santa_message():
-    channel_id = request.args.get("channel_id")
-
-    secret_santa_for_this_group = (
-        all_latest_pairs_view.query.filter_by(channel_id=channel_id)
-        .first()
-        .giver_username
+    channel_id, secret_santa_id = _private_channel(
+        request.args.get("channel_id"), as_giver=False
     )
 
-    secret_santa = User.query.filter_by(username=secret_santa_for_this_group).first()
-
     if request.method == "POST":
-        message = request.json.get("message")
-        new_message = Message(
-            sender_id=current_user.id,
-            receiver_id=secret_santa.id,
-            pair_channel_id=channel_id,
-            text=message,
-            created_at=datetime.now(),
-        )
+        return _send_private_message(channel_id, secret_santa_id, anonymous=False)
 
-        new_message.save_to_db(db)
-
-        _task = Task(
-            name="send_message_notification",
-            started_at=datetime.now(),
-            status="starting",
-            payload={
-                "sender_id": current_user.id,
-                "receiver_id": secret_santa.id,
-                "channel_id": channel_id,
-                "text": message,
-            },
-        )
+    return _private_messages(channel_id)
 
-        _task.save_to_db(db)
 
-        celery.send_task(
-            "user.send_message_notification",
-            (current_user.id, secret_santa.id, channel_id, message, False),
-        )
+@app.route("/chat_stream")
+@login_required
+def chat_stream_events():
+    # Server-sent events for one chat, ?group_id=<id> or ?channel_id=<uuid>. Only the
+    # membership check touches postgres, the rest of the stream just waits on redis
+    group_id = request.args.get("group_id", type=int)
+    if group_id is not None:
+        if not GroupsAndUsersAssociation.query.filter_by(
+            group_id=group_id, user_id=current_user.id
+        ).first():
+            abort(404)
+        channel = chat_stream.channel("group", group_id)
+    else:
+        channel_id, _ = _private_channel(request.args.get("channel_id"))
+        channel = chat_stream.channel("pair", channel_id)
 
-        return jsonify(result=True)
+    # Hand the connection back to the pool now instead of holding it for as long as the tab
+    # stays open
+    db.session.close()
 
-    messages = (
-        Message.query.filter_by(pair_channel_id=channel_id)
-        .order_by(Message.created_at)
-        .all()
-    )
-
-    return jsonify(
-        result=[
-            (
-                "receiver" if message.sender_id == current_user.id else "sender",
-                message.text,
-            )
-            for message in messages
-        ]
+    return Response(
+        stream_with_context(chat_stream.events(channel)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
@@ -1106,7 +1166,7 @@ def report_issue():
 @app.route("/reveal_secret_santa", methods=["GET"])
 def reveal_secret_santa():
     group_name = request.args.get("group_name")
-    secret_santa = all_latest_pairs_view.query.filter_by(
+    secret_santa = LatestPair.query.filter_by(
         group_name=group_name, receiver_username=current_user.username
     ).first()
 
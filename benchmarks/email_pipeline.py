@@ -0,0 +1,199 @@
+"""
+Email pipeline benchmark
+
+Drives the notification pipeline end to end (outbox -> relay -> broker -> workers -> Mailgun) against the stand-ins
+in benchmarks/standins.py and reports emails per second, p50/p99 latency from enqueue to Mailgun accepting the
+email, and how many calls had to be retried.
+
+Unlike the pairing benchmark this needs the whole stack running, because the workers have to see the rows we write:
+postgres, redis, the outbox relay and the celery workers, with the workers pointed at the stand-ins
+
+    python -m benchmarks.standins --port 8025 --rate-limit 50 --error-rate 0.01
+
+    ENV=production MAILGUN_API_KEY=standin \
+    MAILGUN_API_URL=http://localhost:8025/v3 QRNG_API_URL=http://localhost:8025/API/jsonI.php ./celery-init.sh
+
+    python -m benchmarks.email_pipeline --standin-url http://localhost:8025 --members 500 --messages 20 --draw \
+        --output bench_email_pipeline.json
+
+Every run creates a fresh group of `members` users. Run it against a dev database, never production.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+from datetime import datetime
+from time import sleep, time
+from uuid import uuid4
+
+from benchmarks.pairing import create_group, git_revision
+from lib.http.client import http_client
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {"p50": None, "p99": None, "max": None}
+    if len(latencies) == 1:
+        return {"p50": latencies[0], "p99": latencies[0], "max": latencies[0]}
+    return {
+        "p50": statistics.median(latencies),
+        "p99": statistics.quantiles(latencies, n=100)[98],
+        "max": max(latencies),
+    }
+
+
+def enqueue(db, models, celery_task, name, payload):
+    task = models.Task(
+        name=name,
+        started_at=datetime.now(),
+        status="starting",
+        payload=payload,
+    )
+    task.enqueue(db.session, celery_task, idempotency_key=f"bench:{uuid4()}")
+    db.session.commit()
+    return time()
+
+
+def wait_for(standin_url, expected, timeout):
+    # `expected` maps a key identifying each scenario's emails to how many recipients should get one
+    deadline = time() + timeout
+    while True:
+        stats = http_client.get(f"{standin_url}/stats").json()
+        delivered = {key: 0 for key in expected}
+        for message in stats["messages"]:
+            if (key := message_key(message)) in delivered:
+                delivered[key] += message["recipients"]
+        if all(delivered[key] >= count for key, count in expected.items()):
+            return stats, True
+        if time() > deadline:
+            return stats, False
+        sleep(0.5)
+
+
+def message_key(message):
+    variables = message["variables"]
+    if message["template"] == "secret_santa":
+        return ("draw", variables.get("group_name"))
+    return ("chat", variables.get("text"))
+
+
+def run_benchmark(standin_url, members, messages, draw, timeout):
+    os.environ.setdefault("APP_ROOT", os.getcwd())
+
+    import models
+    from app import app, db
+
+    http_client.post(f"{standin_url}/stats/reset")
+
+    with app.app_context():
+        group_id = create_group(db, models, members)
+        group = models.Group.query.get(group_id)
+        sender = group.users[0].user
+
+        enqueued_at, expected = {}, {}
+        started = time()
+        for i in range(messages):
+            text = f"bench {uuid4()}"
+            key = ("chat", text)
+            enqueued_at[key] = enqueue(
+                db,
+                models,
+                "user.send_group_chat_notifications",
+                "send_group_chat_notifications",
+                {
+                    "sender_username": sender.username,
+                    "text": text,
+                    "group_id": group_id,
+                },
+            )
+            expected[key] = members - 1
+
+        if draw:
+            key = ("draw", group.name)
+            enqueued_at[key] = enqueue(
+                db,
+                models,
+                "pair.create_pairs",
+                "create_pairs",
+                {"group_id": group_id, "initiator_id": ""},
+            )
+            expected[key] = members
+
+        stats, finished = wait_for(standin_url, expected, timeout)
+
+    latencies = []
+    accepted_at = []
+    for message in stats["messages"]:
+        if (key := message_key(message)) in enqueued_at:
+            latency = message["accepted_at"] - enqueued_at[key]
+            latencies.extend([latency] * message["recipients"])
+            accepted_at.append(message["accepted_at"])
+
+    counters = stats["counters"]
+    emails = len(latencies)
+    elapsed = (max(accepted_at) - started) if accepted_at else None
+    return {
+        "members": members,
+        "messages": messages,
+        "draw": draw,
+        "finished": finished,
+        "emails": emails,
+        "expected_emails": sum(expected.values()),
+        "elapsed_s": elapsed,
+        "emails_per_second": emails / elapsed if elapsed else None,
+        "latency_s": percentiles(latencies),
+        "mailgun_calls": counters.get("mailgun_requests", 0),
+        "retries": {
+            "mailgun_429": counters.get("mailgun_429", 0),
+            "mailgun_500": counters.get("mailgun_500", 0),
+            "qrng_500": counters.get("qrng_500", 0),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--standin-url", default="http://localhost:8025")
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument(
+        "--messages", type=int, default=20, help="Group chat messages to send"
+    )
+    parser.add_argument(
+        "--draw", action="store_true", help="Also run a draw and email every giver"
+    )
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        args.standin_url, args.members, args.messages, args.draw, args.timeout
+    )
+    print(
+        f"{result['emails']}/{result['expected_emails']} emails, "
+        f"{result['emails_per_second'] or 0:.1f}/s, "
+        f"p50 {result['latency_s']['p50'] or 0:.2f}s, "
+        f"p99 {result['latency_s']['p99'] or 0:.2f}s, "
+        f"retries {result['retries']}",
+        file=sys.stderr,
+    )
+
+    report = {
+        "benchmark": "email_pipeline",
+        "git_revision": git_revision(),
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "results": [result],
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
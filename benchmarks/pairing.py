@@ -0,0 +1,273 @@
+"""
+Pairing benchmark
+
+Runs the pairing pipeline (_make_pairs_async, _make_pairs and the make_pairs task) against a throwaway Postgres
+database with local randomness instead of the QRNG, and no broker. For every group size it records wall time,
+the number of DB round trips and the number of materialized view refreshes, then dumps a JSON report that can be
+diffed across commits.
+
+    python -m benchmarks.pairing \
+        --database-url postgresql://postgres@secret-santa-postgres:5432/postgres \
+        --sizes 10 100 1000 10000 \
+        --output bench_output.json
+
+The database url only needs to point at a server we're allowed to CREATE DATABASE on. A fresh database is created
+for the run and dropped afterwards.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Any valid passlib hash will do. Hashing 10,000 passwords would dominate the setup time otherwise
+PASSWORD_HASH = "$pbkdf2-sha256$29000$xFiLUeq9N2YMgVBKqdXaOw$kcnjB2FPGFk/cr0Yhyw7T4bcCWNaW/NqF8xa1Ktf1OA"
+
+
+@contextmanager
+def throwaway_database(server_url: str):
+    url = make_url(server_url)
+    name = f"bench_{uuid4().hex[:12]}"
+    admin_engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    with admin_engine.connect() as connection:
+        connection.execute(f"CREATE DATABASE {name}")
+    try:
+        yield str(url.set(database=name))
+    finally:
+        with admin_engine.connect() as connection:
+            connection.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+        admin_engine.dispose()
+
+
+class Counters:
+    def __init__(self):
+        self.round_trips = 0
+        self.view_refreshes = 0
+        self.enqueued = 0
+
+    def reset(self):
+        self.__init__()
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        self.round_trips += 1
+        if statement.lstrip().upper().startswith("REFRESH MATERIALIZED VIEW"):
+            self.view_refreshes += 1
+        # Celery messages go out through the outbox table
+        if statement.lstrip().upper().startswith("INSERT INTO OUTBOX"):
+            self.enqueued += 1
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT)
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_group(db, models, size):
+    User, Group, GroupsAndUsersAssociation = (
+        models.User,
+        models.Group,
+        models.GroupsAndUsersAssociation,
+    )
+    suffix = uuid4().hex[:6]
+    group = Group(name=f"bench-{size}-{suffix}")
+    group.save_to_db(db)
+
+    # Core inserts so we don't pay for (or schedule) anything the ORM hooks would do
+    User.bulk_save_to_db(
+        db,
+        [
+            {
+                "username": f"b{suffix}{i}",
+                "first_name": "Bench",
+                "last_name": "Mark",
+                "email": f"b{suffix}{i}@bench.mysecretsanta.io",
+                "password": PASSWORD_HASH,
+                "admin": False,
+            }
+            for i in range(size)
+        ],
+    )
+    user_ids = [
+        user_id
+        for (user_id,) in db.session.query(User.id).filter(
+            User.username.like(f"b{suffix}%")
+        )
+    ]
+    GroupsAndUsersAssociation.bulk_save_to_db(
+        db,
+        [
+            {
+                "user_id": user_id,
+                "group_id": group.id,
+                "group_admin": False,
+                "participating": True,
+            }
+            for user_id in user_ids
+        ],
+    )
+    return group.id
+
+
+def start_task(db, models, group_id):
+    task = models.Task(
+        name="create_pairs",
+        payload={"group_id": group_id, "initiator_id": ""},
+        started_at=datetime.now(),
+        status="starting",
+    )
+    task.save_to_db(db)
+    return task
+
+
+def measure(counters, repeat, run, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        counters.reset()
+        started = perf_counter()
+        run()
+        samples.append(
+            {
+                "wall_time_s": perf_counter() - started,
+                "db_round_trips": counters.round_trips,
+                "view_refreshes": counters.view_refreshes,
+                "tasks_enqueued": counters.enqueued,
+            }
+        )
+
+    wall_times = [sample["wall_time_s"] for sample in samples]
+    return {
+        "wall_time_s": {
+            "min": min(wall_times),
+            "median": statistics.median(wall_times),
+            "max": max(wall_times),
+        },
+        # These don't change between repeats unless something is badly wrong, so report the worst
+        "db_round_trips": max(sample["db_round_trips"] for sample in samples),
+        "view_refreshes": max(sample["view_refreshes"] for sample in samples),
+        "tasks_enqueued": max(sample["tasks_enqueued"] for sample in samples),
+    }
+
+
+def run_benchmarks(sizes, repeat):
+    # Everything below reads its config from the environment at import time
+    os.environ.setdefault("APP_ROOT", REPO_ROOT)
+
+    import models
+    import tasks
+    from app import app, db
+    from lib.entropy.pool import EntropyPool
+    from lib.entropy.sources import LocalSource
+
+    counters = Counters()
+    tasks.entropy_pool = EntropyPool(LocalSource())
+
+    results = []
+    with app.app_context():
+        db.create_all()
+        # tasks is partitioned by month and create_all only makes the parent table
+        models.task_partitions.create_upcoming()
+        event.listen(db.engine, "before_cursor_execute", counters.before_cursor_execute)
+
+        for size in sizes:
+            group_id = create_group(db, models, size)
+            pipe = {"group_id": group_id}
+
+            def make_pairs_async():
+                pipe.update(
+                    asyncio.run(tasks._make_pairs_async(pipe={"group_id": group_id}))
+                )
+
+            def make_pairs():
+                tasks._make_pairs(pipe=pipe)
+
+            started = {}
+
+            for stage, run, setup in (
+                ("_make_pairs_async", make_pairs_async, None),
+                ("_make_pairs", make_pairs, None),
+                # The task looks up the Task row the web app would have created
+                (
+                    "make_pairs",
+                    lambda: tasks.make_pairs(started["task"].id),
+                    lambda: started.update(task=start_task(db, models, group_id)),
+                ),
+            ):
+                result = measure(counters, repeat, run, setup)
+                print(
+                    f"{stage:>18} {size:>6} members : "
+                    f"{result['wall_time_s']['median']:.3f}s, "
+                    f"{result['db_round_trips']} round trips, "
+                    f"{result['view_refreshes']} view refreshes",
+                    file=sys.stderr,
+                )
+                results.append({"stage": stage, "members": size, **result})
+
+        event.remove(db.engine, "before_cursor_execute", counters.before_cursor_execute)
+        db.session.remove()
+        db.engine.dispose()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--database-url",
+        default=os.getenv("BENCHMARK_DATABASE_URL", os.getenv("DATABASE_URL")),
+        help="Postgres server to create the throwaway database on",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1_000, 10_000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url (or BENCHMARK_DATABASE_URL) is required")
+
+    with throwaway_database(args.database_url) as database_url:
+        os.environ["DATABASE_URL"] = database_url
+        results = run_benchmarks(args.sizes, args.repeat)
+
+    report = {
+        "benchmark": "pairing",
+        "git_revision": git_revision(),
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
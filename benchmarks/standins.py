@@ -0,0 +1,160 @@
+"""
+Mailgun and QRNG stand-ins
+
+A small aiohttp server that answers like the two APIs we depend on, so the email pipeline and the draw can be load
+tested without sending real mail or leaning on the ANU. Point the workers at it with
+
+    MAILGUN_API_URL=http://localhost:8025/v3 MAILGUN_API_KEY=standin QRNG_API_URL=http://localhost:8025/API/jsonI.php
+
+    python -m benchmarks.standins --port 8025 --latency 120 --jitter 40 --error-rate 0.01 --rate-limit 50
+
+Every response waits `latency` +/- `jitter` ms. `error-rate` of the requests fail with a 500. `rate-limit` caps how
+many Mailgun calls per second get through, everything over it gets a 429 like the real thing does. GET /stats
+returns counters for both APIs plus every accepted Mailgun message (when it was accepted, which template, its
+variables and how many recipients), and POST /stats/reset clears them between runs.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+from collections import Counter
+from random import random, randint, uniform
+from time import time
+from uuid import uuid4
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class StandIn:
+    def __init__(
+        self,
+        latency: float = 100,
+        jitter: float = 0,
+        error_rate: float = 0,
+        rate_limit: float = 0,
+    ):
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.messages = []
+        self._tokens = self.rate_limit
+        self._refilled_at = time()
+
+    async def _respond_after_latency(self):
+        await asyncio.sleep(max(0, uniform(-self.jitter, self.jitter) + self.latency))
+
+    def _throttled(self) -> bool:
+        # Same token bucket idea as the real provider. No limit at all when rate_limit is 0
+        if not self.rate_limit:
+            return False
+        now = time()
+        self._tokens = min(
+            self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit
+        )
+        self._refilled_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    async def mailgun_messages(self, request: web.Request) -> web.Response:
+        self.counters["mailgun_requests"] += 1
+        if self._throttled():
+            self.counters["mailgun_429"] += 1
+            return web.json_response({"message": "Too Many Requests"}, status=429)
+
+        form = await request.post()
+        await self._respond_after_latency()
+
+        if random() < self.error_rate:
+            self.counters["mailgun_500"] += 1
+            return web.json_response({"message": "Internal Server Error"}, status=500)
+
+        recipients = form.getall("to", [])
+        self.counters["mailgun_accepted"] += 1
+        self.counters["mailgun_recipients"] += len(recipients)
+        self.messages.append(
+            {
+                "accepted_at": time(),
+                "template": form.get("template"),
+                "variables": json.loads(form.get("h:X-Mailgun-Variables", "{}")),
+                "recipients": len(recipients),
+            }
+        )
+        return web.json_response(
+            {"id": f"<{uuid4()}@standin>", "message": "Queued. Thank you."}
+        )
+
+    async def qrng(self, request: web.Request) -> web.Response:
+        self.counters["qrng_requests"] += 1
+        await self._respond_after_latency()
+
+        if random() < self.error_rate:
+            self.counters["qrng_500"] += 1
+            return web.Response(status=500)
+
+        length = min(int(request.query.get("length", 1)), 1024)
+        self.counters["qrng_numbers"] += length
+        return web.json_response(
+            {
+                "type": "uint16",
+                "length": length,
+                "data": [randint(0, 65535) for _ in range(length)],
+                "success": True,
+            }
+        )
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"counters": dict(self.counters), "messages": self.messages}
+        )
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({"reset": True})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/v3/{domain}/messages", self.mailgun_messages),
+                web.get("/API/jsonI.php", self.qrng),
+                web.get("/stats", self.stats),
+                web.post("/stats/reset", self.reset_stats),
+            ]
+        )
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=100, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=20, help="milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Mailgun calls per second"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    standin = StandIn(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+    )
+    web.run_app(standin.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,4 @@
 #!/usr/bin/env bash
-celery -A tasks.celery worker --uid=$UID --loglevel=INFO --concurrency=$(expr 2 \* $(nproc) + 1) -n worker1@%h
\ No newline at end of file
+# WORKER_PROFILE picks the queues and pool this worker runs (see celery_config.py)
+export WORKER_PROFILE=${WORKER_PROFILE:-all}
+celery -A tasks.celery worker --uid=$UID --loglevel=INFO $(python celery_config.py $WORKER_PROFILE) -n $WORKER_PROFILE@%h
@@ -0,0 +1,104 @@
+"""
+Shared celery settings and worker profiles. Everything that sends or runs celery tasks (the web app, the workers, the
+materialized view scheduler) loads this module with `celery.config_from_object("celery_config")`, so they all agree on
+where every task goes.
+
+A worker profile is a named set of queues plus how to consume them. celery-init.sh picks one with WORKER_PROFILE and
+gets its `celery worker` flags from `python celery_config.py <profile>`. `all` consumes every queue with one prefork
+pool, which is what you want for dev and single box deploys
+"""
+
+import os
+import sys
+from multiprocessing import cpu_count
+
+broker_url = os.environ.get("CELERY_BROKER_URL")
+
+# Redis has no real priorities. The transport emulates them with a list per priority step, 0 being the most urgent.
+# That only orders messages within a queue. Queues themselves are consumed round robin, so a worker on several
+# queues (`all`) never starves one of them because another has a backlog
+broker_transport_options = {"priority_steps": list(range(10))}
+
+WORKER_PROFILES = {
+    # Email and notifications. Almost all of the time is spent waiting on Mailgun, so lots of green threads.
+    # Also picks up anything sent without a route, which lands on celery's default queue
+    "users": {
+        "queues": ["users_queue", "celery"],
+        "routes": ["user.*"],
+        "pool": "gevent",
+        "concurrency": int(os.getenv("USERS_WORKER_CONCURRENCY", 100)),
+        "prefetch_multiplier": 4,
+        "acks_late": True,
+        "priority": 5,
+        "beat": False,
+    },
+    # Draws. CPU bound and holds advisory locks, so a few processes that only take one message at a time
+    "pairs": {
+        "queues": ["pairs_queue"],
+        "routes": ["pair.*"],
+        "pool": "prefork",
+        "concurrency": int(os.getenv("PAIRS_WORKER_CONCURRENCY", 2)),
+        "prefetch_multiplier": 1,
+        "acks_late": True,
+        "priority": 0,
+        "beat": False,
+    },
+    # View refreshes and partition upkeep. Runs the beat schedule too, so only start one of these
+    "maintenance": {
+        "queues": ["maintenance_queue"],
+        "routes": ["view.*", "maintenance.*"],
+        "pool": "solo",
+        "concurrency": 1,
+        "prefetch_multiplier": 1,
+        "acks_late": False,
+        "priority": 9,
+        "beat": True,
+    },
+}
+
+WORKER_PROFILES["all"] = {
+    "queues": list(
+        dict.fromkeys(
+            queue for profile in WORKER_PROFILES.values() for queue in profile["queues"]
+        )
+    ),
+    "routes": [],
+    "pool": "prefork",
+    "concurrency": 2 * cpu_count() + 1,
+    "prefetch_multiplier": 1,
+    "acks_late": True,
+    "priority": 5,
+    "beat": True,
+}
+
+task_routes = {
+    route: {"queue": profile["queues"][0], "priority": profile["priority"]}
+    for profile in WORKER_PROFILES.values()
+    for route in profile["routes"]
+}
+
+task_default_priority = 5
+
+_profile = WORKER_PROFILES[os.getenv("WORKER_PROFILE", "all")]
+worker_pool = _profile["pool"]
+worker_concurrency = _profile["concurrency"]
+worker_prefetch_multiplier = _profile["prefetch_multiplier"]
+task_acks_late = _profile["acks_late"]
+# With acks_late a task whose worker dies gets redelivered instead of lost
+task_reject_on_worker_lost = _profile["acks_late"]
+
+
+def worker_args(name: str):
+    profile = WORKER_PROFILES[name]
+    args = [
+        f"--pool={profile['pool']}",
+        f"--concurrency={profile['concurrency']}",
+        f"--queues={','.join(profile['queues'])}",
+    ]
+    if profile["beat"]:
+        args += ["--beat", "--schedule=/tmp/celerybeat-schedule"]
+    return args
+
+
+if __name__ == "__main__":
+    print(" ".join(worker_args(sys.argv[1])))
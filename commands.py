@@ -1,11 +1,12 @@
-from models import User, Group, GroupsAndUsersAssociation
+from models import User, Group, GroupsAndUsersAssociation, task_partitions
 from getpass import getpass
 from flask_script import Command
 from faker import Faker
-from app import db
+from app import celery, db
 from os import environ
 from random import choice, choices
 from uuid import uuid4
+from sql.outbox import OutboxRelay
 
 
 class CreateSuperUser(Command):
@@ -64,3 +65,19 @@ class SeedDatabase(Command):
 
         else:
             print("Can't run this command in production")
+
+
+class MaintainTaskPartitions(Command):
+    def run(self):
+        task_partitions.maintain()
+        print(f"tasks partitions: {', '.join(task_partitions.partitions())}")
+
+
+class RelayOutbox(Command):
+    def run(self):
+        OutboxRelay(
+            db,
+            celery,
+            batch_size=int(environ.get("OUTBOX_BATCH_SIZE", 500)),
+            poll_interval=float(environ.get("OUTBOX_POLL_INTERVAL", 0.5)),
+        ).run()
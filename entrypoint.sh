@@ -5,7 +5,7 @@ python manage.py db upgrade
 CONCURRENCY=$(expr 2 \* $(nproc) + 1)
 gunicorn -w  $CONCURRENCY \
     --worker-class=gevent \
-    --worker-connections=100 \
+    --worker-connections=1000 \
     --timeout 120 \
     --log-level=debug \
     --threads=$CONCURRENCY \
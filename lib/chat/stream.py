@@ -0,0 +1,58 @@
+import json
+import logging
+from functools import cached_property
+from typing import Dict, Iterator
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class ChatStream:
+    """
+    Chat messages pushed to browsers over redis pub/sub and server-sent events. Messages are published on their chat's
+    redis channel once committed, and every open chat holds one `events` stream that forwards them as SSE `data:`
+    lines without touching postgres. That only works with gunicorn's gevent workers, where a blocked subscription just
+    parks its greenlet.
+
+    Pub/sub is fire and forget, so clients catch up with a regular ?after=<id> fetch every time their EventSource
+    (re)opens. For the same reason publishing never raises, the next catch up picks the message up
+    """
+
+    def __init__(self, broker_url: str, prefix: str = "chat", heartbeat: float = 15):
+        self.broker_url = broker_url
+        self.prefix = prefix
+        # Proxies drop connections that go quiet, and a comment line is also how we find out the
+        # browser went away without waiting for the next message
+        self.heartbeat = heartbeat
+
+    @cached_property
+    def redis(self):
+        return redis.Redis.from_url(self.broker_url)
+
+    def channel(self, kind: str, id) -> str:
+        return f"{self.prefix}:{kind}:{id}"
+
+    def publish(self, channel: str, message: Dict):
+        try:
+            self.redis.publish(channel, json.dumps(message, default=str))
+        except redis.RedisError as e:
+            logger.warning(f"Couldn't publish to {channel}, clients will catch up: {e}")
+
+    def events(self, channel: str) -> Iterator[str]:
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(channel)
+            # How long the browser waits before reconnecting, in ms
+            yield "retry: 3000\n\n"
+            while True:
+                message = pubsub.get_message(timeout=self.heartbeat)
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message['data'].decode()}\n\n"
+        except redis.RedisError as e:
+            # Ending the response makes the EventSource reconnect (and catch up) on its own
+            logger.warning(f"Chat stream for {channel} lost redis: {e}")
+        finally:
+            pubsub.close()
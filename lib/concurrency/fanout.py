@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Set
+
+logger = logging.getLogger(__name__)
+
+
+class FanOutResult:
+    """
+    What came back from `fan_out`, keyed by the position of each call in the original list.
+    Every call ends up in exactly one of `results`, `errors` or `timed_out`
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.results: Dict[int, Any] = {}
+        self.errors: Dict[int, BaseException] = {}
+        self.timed_out: Set[int] = set()
+
+    @property
+    def complete(self) -> bool:
+        return len(self.results) == self.size
+
+    @property
+    def failed(self) -> Set[int]:
+        return set(self.errors) | self.timed_out
+
+    def ordered_results(self):
+        return [self.results[index] for index in sorted(self.results)]
+
+    def __str__(self):
+        return (
+            f"{len(self.results)}/{self.size} succeeded, "
+            f"{len(self.errors)} failed, {len(self.timed_out)} timed out"
+        )
+
+    __repr__ = __str__
+
+
+async def fan_out(
+    calls: Sequence[Callable[[], Awaitable]],
+    concurrency: int = 10,
+    call_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> FanOutResult:
+    """
+    Runs a bunch of coroutines with at most `concurrency` of them in flight at any time. `calls` are zero argument
+    callables that return a coroutine (not coroutines themselves) so nothing starts before it gets a slot.
+
+    `call_timeout` caps every single call and `deadline` caps the whole fan-out, cancelling anything still running.
+    Nothing raises, a failure in one call never takes the others down with it. Look at the returned FanOutResult to
+    decide what to do with partial results
+    """
+    outcome = FanOutResult(len(calls))
+    if not calls:
+        return outcome
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            if call_timeout is None:
+                return await call()
+            return await asyncio.wait_for(call(), call_timeout)
+
+    futures = {
+        asyncio.ensure_future(run(call)): index for index, call in enumerate(calls)
+    }
+    done, pending = await asyncio.wait(futures, timeout=deadline)
+
+    for future in pending:
+        future.cancel()
+        outcome.timed_out.add(futures[future])
+    if pending:
+        logger.warning(f"Fan-out deadline hit with {len(pending)} calls still running")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    for future in done:
+        index = futures[future]
+        error = future.exception()
+        if isinstance(error, asyncio.TimeoutError):
+            outcome.timed_out.add(index)
+        elif error is not None:
+            outcome.errors[index] = error
+        else:
+            outcome.results[index] = future.result()
+
+    return outcome
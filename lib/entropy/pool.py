@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from functools import partial
+from typing import List
+
+from aiohttp.client_exceptions import ClientConnectionError
+
+from lib.concurrency.fanout import fan_out
+
+from .sources import EntropySource
+
+logger = logging.getLogger(__name__)
+
+
+class EntropyPool:
+    """
+    Keeps a bounded buffer of random numbers around so a draw doesn't have to go to the network once per member.
+    Numbers are fetched from the source in blocks (up to `source.max_block_size` per request), and a background thread
+    tops the buffer back up to `capacity` whenever it dips below `low_watermark`. If a draw needs more than we have
+    buffered, the shortfall is fetched right away and any leftovers are kept for next time.
+
+    Every number is handed out exactly once, and the buffer is thrown away after a fork so two worker processes never
+    share the same randomness
+    """
+
+    def __init__(
+        self,
+        source: EntropySource,
+        capacity: int = 4096,
+        low_watermark: int = 1024,
+        concurrency: int = 4,
+        call_timeout: float = 10,
+        deadline: float = 30,
+    ):
+        self.source = source
+        self.capacity = capacity
+        self.low_watermark = low_watermark
+        # Block requests in flight at once, and how long each one / all of them together may take
+        self.concurrency = concurrency
+        self.call_timeout = call_timeout
+        self.deadline = deadline
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._refill_thread = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def __len__(self):
+        self._check_pid()
+        return len(self._buffer)
+
+    def _pop(self, count: int) -> List[int]:
+        with self._lock:
+            return [
+                self._buffer.popleft() for _ in range(min(count, len(self._buffer)))
+            ]
+
+    def _push(self, numbers: List[int]):
+        with self._lock:
+            room = max(self.capacity - len(self._buffer), 0)
+            self._buffer.extend(numbers[:room])
+
+    def _block_sizes(self, count: int) -> List[int]:
+        block_size = self.source.max_block_size
+        full_blocks, remainder = divmod(count, block_size)
+        return [block_size] * full_blocks + ([remainder] if remainder else [])
+
+    async def _fetch(self, count: int) -> List[int]:
+        """
+        Fetch `count` numbers in blocks, a few blocks at a time. Whatever blocks made it back are returned even if
+        some of them failed, so the caller can keep them and only go back for the rest
+        """
+        result = await fan_out(
+            [partial(self.source.fetch, size) for size in self._block_sizes(count)],
+            concurrency=self.concurrency,
+            call_timeout=self.call_timeout,
+            deadline=self.deadline,
+        )
+        if not result.complete:
+            logger.warning(f"Only got part of the entropy we asked for: {result}")
+        return [number for block in result.ordered_results() for number in block]
+
+    async def take(self, count: int) -> List[int]:
+        """
+        Hand out `count` random numbers. Only goes to the network if the buffer can't cover it
+        """
+        self._check_pid()
+        numbers = self._pop(count)
+        shortfall = count - len(numbers)
+        if shortfall:
+            logger.debug(f"Entropy pool is {shortfall} numbers short. Fetching now")
+            # Round up to whole blocks. Whatever we don't need right now goes into the buffer
+            block_size = self.source.max_block_size
+            fetched = await self._fetch(-(-shortfall // block_size) * block_size)
+            numbers.extend(fetched[:shortfall])
+            self._push(fetched[shortfall:])
+
+            if len(numbers) < count:
+                # Hang on to what we did get so a retry only has to fetch the rest
+                self._push(numbers)
+                raise ClientConnectionError(
+                    f"Only got {len(numbers)} of the {count} random numbers we needed"
+                )
+
+        self.schedule_refill()
+        return numbers
+
+    def schedule_refill(self):
+        """
+        Top the buffer back up to `capacity` in a background thread if it has dipped below `low_watermark`
+        """
+        self._check_pid()
+        if len(self._buffer) >= self.low_watermark:
+            return
+        with self._lock:
+            if self._refill_thread and self._refill_thread.is_alive():
+                return
+            self._refill_thread = threading.Thread(
+                target=self._refill, name="entropy-pool-refill", daemon=True
+            )
+            self._refill_thread.start()
+
+    def _refill(self):
+        missing = self.capacity - len(self._buffer)
+        if missing <= 0:
+            return
+        try:
+            self._push(asyncio.run(self._fetch(missing)))
+            logger.debug(f"Refilled entropy pool with {missing} numbers")
+        except Exception as e:
+            # Not the end of the world. The next draw will just fetch what it needs on the spot
+            logger.warning(f"Failed to refill entropy pool: {e}")
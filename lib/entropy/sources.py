@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import os
+from secrets import randbits
+from typing import List
+
+from lib.http.client import http_client
+
+logger = logging.getLogger(__name__)
+
+QRNG_API_URL = os.getenv("QRNG_API_URL", "https://qrng.anu.edu.au/API/jsonI.php")
+
+
+class EntropySource:
+    """
+    Something that can hand us a block of random unsigned 16 bit integers in one go.
+    Subclasses only need to implement `fetch`
+    """
+
+    # Largest block a single call to `fetch` is allowed to ask for
+    max_block_size: int = 1024
+
+    async def fetch(self, count: int) -> List[int]:
+        raise NotImplementedError
+
+
+class QRNGSource(EntropySource):
+    """
+    The ANU quantum random number generator. One GET gives us up to 1024 numbers
+
+    GET https://qrng.anu.edu.au/API/jsonI.php?length=1024&type=uint16
+    {"type": "uint16", "length": 1024, "data": [32118, 951, ...], "success": true}
+    """
+
+    def __init__(self, url: str = QRNG_API_URL):
+        self.url = url
+
+    async def fetch(self, count: int) -> List[int]:
+        # Goes through the process wide connection pool. The entropy pool fetches from a fresh event loop every time, so
+        # an aiohttp session could never keep its connections alive between draws
+        count = min(count, self.max_block_size)
+        resp = await asyncio.to_thread(
+            http_client.get, self.url, params={"length": count, "type": "uint16"}
+        )
+        resp.raise_for_status()
+        body = resp.json()
+        if not body.get("success"):
+            raise ValueError(f"QRNG refused to hand out {count} numbers: {body}")
+        return [int(number) for number in body["data"]]
+
+
+class LocalSource(EntropySource):
+    """
+    Stand-in for the QRNG that never touches the network. Handy for dev and benchmarks
+    """
+
+    max_block_size = 1 << 16
+
+    async def fetch(self, count: int) -> List[int]:
+        return [randbits(16) for _ in range(min(count, self.max_block_size))]
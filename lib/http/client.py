@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPClient:
+    """
+    One keep-alive connection pool per process for everything we call over HTTP. requests.post/requests.get open a
+    brand new connection on every call and wait forever by default. This keeps a single requests.Session around
+    instead, gives every call a (connect, read) timeout unless it asks for something else, and rebuilds the session
+    after a fork so processes never share sockets.
+
+    `pool_maxsize` is how many connections we keep per host and `host_limits` overrides that for specific hosts. The
+    pools block when they're full, so that's also the most requests we'll have in flight to a host from one process
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10,
+        pool_maxsize: int = 10,
+        host_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+        self.host_limits = host_limits or {}
+        self._pid = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _adapter(self, maxsize: int) -> HTTPAdapter:
+        return HTTPAdapter(pool_maxsize=maxsize, pool_block=True)
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount("https://", self._adapter(self.pool_maxsize))
+        session.mount("http://", self._adapter(self.pool_maxsize))
+        # requests picks the adapter with the longest matching prefix
+        for prefix, maxsize in self.host_limits.items():
+            session.mount(prefix, self._adapter(maxsize))
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    logger.debug(f"opening http connection pool for pid {os.getpid()}")
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+def _host_limits(spec: str) -> Dict[str, int]:
+    # "https://api.mailgun.net=20,https://qrng.anu.edu.au=4"
+    limits = {}
+    for entry in filter(None, spec.split(",")):
+        prefix, maxsize = entry.rsplit("=", 1)
+        limits[prefix.strip()] = int(maxsize)
+    return limits
+
+
+http_client = HTTPClient(
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", 10)),
+    pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", 10)),
+    host_limits=_host_limits(os.getenv("HTTP_HOST_LIMITS", "")),
+)
@@ -2,7 +2,7 @@ import json
 import logging
 import os
 
-import requests
+from lib.http.client import http_client
 
 from .base import OAuthHandler, OAuthUser
 
@@ -47,7 +47,7 @@ class Google(OAuthHandler):
         )
 
     def user_data(self, code: str) -> OAuthUser:
-        _resp = requests.post(
+        _resp = http_client.post(
             self.access_token_url,
             data={
                 "client_id": self.client_id,
@@ -62,7 +62,7 @@ class Google(OAuthHandler):
         logger.info(data)
         access_token, id_token = data["access_token"], data["id_token"]
 
-        resp = requests.get(
+        resp = http_client.get(
             "https://www.googleapis.com/oauth2/v1/userinfo",
             params={
                 "alt": "json",
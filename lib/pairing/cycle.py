@@ -0,0 +1,167 @@
+import logging
+from typing import Dict, Hashable, List, Mapping, Optional, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How many DFS steps we're willing to spend proving there's no valid cycle before giving up
+MAX_SEARCH_STEPS = 200_000
+
+
+class PairingInfeasible(Exception):
+    pass
+
+
+class PairingSearchExhausted(Exception):
+    # Not the same as infeasible. There may well be a valid loop, we just stopped looking
+    pass
+
+
+class SingleCycle:
+    """
+    Builds one big gift-giving loop (A -> B -> C -> ... -> A) that respects exclusions. `members` are the people in
+    the draw, `weights` are their random numbers (same order) and `exclusions` maps a giver to the receivers they must
+    NOT get (last year's santee, their partner etc). Nobody is ever paired with themselves.
+
+    Sorting members by weight gives a uniformly random loop, and every forbidden edge in it is repaired by swapping the
+    receiver with someone further down the loop, which is ~O(n) with a handful of exclusions per person. Tiny or very
+    constrained groups where repairing gets stuck fall back to an exhaustive search
+    """
+
+    def __init__(
+        self,
+        members: Sequence[Hashable],
+        weights: Sequence[int],
+        exclusions: Optional[Mapping[Hashable, Set[Hashable]]] = None,
+    ):
+        if len(members) != len(weights):
+            raise ValueError("Every member needs exactly one weight")
+        self.members = list(members)
+        self.weights = list(weights)
+        self.exclusions = exclusions or {}
+
+    def allowed(self, giver, receiver) -> bool:
+        return giver != receiver and receiver not in self.exclusions.get(giver, ())
+
+    def solve(self) -> List[Tuple[Hashable, Hashable]]:
+        n = len(self.members)
+        if n < 2:
+            raise PairingInfeasible(f"Need at least 2 members to make pairs, got {n}")
+
+        self._check_everyone_has_options()
+
+        order = [
+            member
+            for _, _, member in sorted(
+                zip(self.weights, range(n), self.members), key=lambda k: k[:2]
+            )
+        ]
+
+        if not self._repair(order):
+            logger.debug("Couldn't repair the random loop. Searching exhaustively")
+            order = self._search(order)
+
+        return [(giver, order[(index + 1) % n]) for index, giver in enumerate(order)]
+
+    def _check_everyone_has_options(self):
+        for member in self.members:
+            if not any(self.allowed(member, other) for other in self.members):
+                raise PairingInfeasible(f"{member} can't give a gift to anyone")
+            if not any(self.allowed(other, member) for other in self.members):
+                raise PairingInfeasible(f"Nobody can give a gift to {member}")
+
+    def _edges_ok(self, order: List, positions: Set[int]) -> bool:
+        n = len(order)
+        for p in positions:
+            if not self.allowed(order[(p - 1) % n], order[p]):
+                return False
+            if not self.allowed(order[p], order[(p + 1) % n]):
+                return False
+        return True
+
+    def _repair(self, order: List) -> bool:
+        n = len(order)
+        weight_of = dict(zip(self.members, self.weights))
+        for _ in range(n):
+            bad = [
+                index
+                for index in range(n)
+                if not self.allowed(order[index], order[(index + 1) % n])
+            ]
+            if not bad:
+                return True
+
+            progress = False
+            for index in bad:
+                receiver_position = (index + 1) % n
+                if self.allowed(order[index], order[receiver_position]):
+                    # An earlier swap already fixed this one
+                    continue
+                # Start looking for a swap partner somewhere random (but reproducible) in the loop
+                start = weight_of[order[index]] % n
+                for offset in range(n):
+                    other = (start + offset) % n
+                    if other == receiver_position:
+                        continue
+                    order[receiver_position], order[other] = (
+                        order[other],
+                        order[receiver_position],
+                    )
+                    if self._edges_ok(order, {receiver_position, other}):
+                        progress = True
+                        break
+                    order[receiver_position], order[other] = (
+                        order[other],
+                        order[receiver_position],
+                    )
+            if not progress:
+                return False
+        return False
+
+    def _search(self, order: List) -> List:
+        """
+        Depth first search for a Hamiltonian cycle over the allowed edges. Candidates are tried in the (random)
+        order we already have, so we still get a random looking answer when one exists
+        """
+        n = len(order)
+        rank = {member: index for index, member in enumerate(order)}
+        candidates: Dict[Hashable, List] = {
+            giver: sorted(
+                (receiver for receiver in order if self.allowed(giver, receiver)),
+                key=lambda receiver: rank[receiver],
+            )
+            for giver in order
+        }
+
+        start = order[0]
+        path = [start]
+        visited = {start}
+        # One iterator per position in the path so we can backtrack without recursion
+        stack = [iter(candidates[start])]
+        steps = 0
+        while stack:
+            steps += 1
+            if steps > MAX_SEARCH_STEPS:
+                raise PairingSearchExhausted(
+                    f"Gave up looking for a valid loop after {MAX_SEARCH_STEPS} steps"
+                )
+            if len(path) == n:
+                if self.allowed(path[-1], start):
+                    return path
+                stack.pop()
+                visited.discard(path.pop())
+                continue
+
+            receiver = next(
+                (r for r in stack[-1] if r not in visited),
+                None,
+            )
+            if receiver is None:
+                stack.pop()
+                visited.discard(path.pop())
+                continue
+
+            path.append(receiver)
+            visited.add(receiver)
+            stack.append(iter(candidates[receiver]))
+
+        raise PairingInfeasible("There is no way to pair up this group")
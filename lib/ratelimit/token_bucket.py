@@ -0,0 +1,139 @@
+import logging
+from collections import Counter
+from functools import cached_property
+from typing import Dict, Iterable, Tuple
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS are the buckets. ARGV is (rate, capacity, cost) for every bucket, in the same order.
+# Either every bucket has enough tokens and all of them are charged, or none are and we return how long the caller
+# has to wait for the emptiest one. Returned as a string because redis turns lua numbers into integers
+ACQUIRE = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wait = 0
+local buckets = {}
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local cost = math.min(tonumber(ARGV[i * 3]), capacity)
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+    buckets[i] = {tokens - cost, math.ceil(capacity / rate) + 1}
+end
+
+if wait > 0 then
+    return tostring(wait)
+end
+
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', buckets[i][1], 'updated_at', now)
+    redis.call('EXPIRE', key, buckets[i][2])
+end
+return '0'
+"""
+
+
+class RateLimited(Exception):
+    def __init__(self, wait: float, buckets: Iterable[str] = ()):
+        self.wait = wait
+        self.buckets = list(buckets)
+        super().__init__(f"Rate limited on {', '.join(self.buckets)} for {wait:.2f}s")
+
+
+class TokenBuckets:
+    """
+    Token buckets in redis, shared by every process that talks to the same redis. A bucket holds up to `capacity`
+    tokens and refills at `rate` tokens per second. Taking tokens from several buckets at once is atomic (one lua
+    script), so a send that's over the limit on any of them doesn't use up tokens on the others. A single request
+    never costs more than a bucket's capacity.
+
+    Nothing ever sleeps in here. `acquire` returns how long to wait and it's up to the caller to come back later. If
+    redis is down we let everything through rather than stop sending mail
+    """
+
+    def __init__(self, broker_url: str, prefix: str = "ratelimit"):
+        self.broker_url = broker_url
+        self.prefix = prefix
+
+    @cached_property
+    def redis(self):
+        return redis.Redis.from_url(self.broker_url)
+
+    @cached_property
+    def _acquire(self):
+        return self.redis.register_script(ACQUIRE)
+
+    def acquire(self, buckets: Dict[str, Tuple[float, float, float]]) -> float:
+        if not buckets:
+            return 0
+        names = list(buckets)
+        try:
+            wait = self._acquire(
+                keys=[f"{self.prefix}:{name}" for name in names],
+                args=[value for name in names for value in buckets[name]],
+            )
+        except redis.RedisError as e:
+            logger.warning(
+                f"Rate limiter unavailable, letting the request through: {e}"
+            )
+            return 0
+        return float(wait)
+
+
+class EmailRateLimiter:
+    """
+    One bucket for the provider as a whole (counted in API calls) and one per recipient domain (counted in
+    recipients), since gmail.com and friends throttle senders on their own no matter what the provider allows
+    """
+
+    def __init__(
+        self,
+        buckets: TokenBuckets,
+        provider: str,
+        provider_rate: float,
+        provider_burst: float,
+        domain_rate: float,
+        domain_burst: float,
+    ):
+        self.buckets = buckets
+        self.provider = provider
+        self.provider_rate = provider_rate
+        self.provider_burst = provider_burst
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+
+    def _buckets(
+        self, recipients: Iterable[str]
+    ) -> Dict[str, Tuple[float, float, float]]:
+        domains = Counter(
+            recipient.rsplit("@", 1)[-1].lower() for recipient in recipients
+        )
+        return {
+            self.provider: (self.provider_rate, self.provider_burst, 1),
+            **{
+                f"{self.provider}:domain:{domain}": (
+                    self.domain_rate,
+                    self.domain_burst,
+                    count,
+                )
+                for domain, count in domains.items()
+            },
+        }
+
+    def check(self, recipients: Iterable[str]):
+        """
+        Takes the tokens for one send to `recipients`, or raises RateLimited with how long to wait
+        """
+        buckets = self._buckets(recipients)
+        if wait := self.buckets.acquire(buckets):
+            raise RateLimited(wait, buckets)
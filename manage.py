@@ -1,6 +1,6 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
-from commands import CreateSuperUser, SeedDatabase
+from commands import CreateSuperUser, MaintainTaskPartitions, RelayOutbox, SeedDatabase
 from app import app, db
 
 
@@ -9,6 +9,8 @@ manager = Manager(app)
 manager.add_command("db", MigrateCommand)
 manager.add_command("createsuperuser", CreateSuperUser)
 manager.add_command("seed", SeedDatabase)
+manager.add_command("partition_tasks", MaintainTaskPartitions)
+manager.add_command("relay_outbox", RelayOutbox)
 
 if __name__ == "__main__":
     manager.run()
@@ -3,6 +3,7 @@ from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
 import logging
+import re
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -24,6 +25,17 @@ config.set_main_option(
 )
 target_metadata = current_app.extensions["migrate"].db.metadata
 
+# sql.partitions.MonthlyPartitions creates (and detaches) these at runtime. They aren't
+# models, so without this autogenerate would write drop_table ops for them
+TASK_PARTITION = re.compile(r"^tasks_\d{4}_\d{2}$")
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == "table" and reflected and TASK_PARTITION.match(name):
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -78,6 +90,7 @@ def run_migrations_online():
         connection=connection,
         target_metadata=target_metadata,
         compare_type=True,
+        include_object=include_object,
         process_revision_directives=process_revision_directives,
         **current_app.extensions["migrate"].configure_args
     )
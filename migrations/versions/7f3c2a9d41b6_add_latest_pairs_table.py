@@ -0,0 +1,98 @@
+"""add latest_pairs table
+
+Revision ID: 7f3c2a9d41b6
+Revises: 05d3bcc394b7
+Create Date: 2026-10-18 19:40:12.118342
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "7f3c2a9d41b6"
+down_revision = "05d3bcc394b7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "latest_pairs",
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("giver_id", sa.Integer(), nullable=False),
+        sa.Column("receiver_id", sa.Integer(), nullable=True),
+        sa.Column("channel_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("giver_username", sa.String(length=20), nullable=True),
+        sa.Column("receiver_username", sa.String(length=20), nullable=True),
+        sa.Column("group_name", sa.String(length=200), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["channel_id"], ["pairs.channel_id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["giver_id"],
+            ["users.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["group_id"],
+            ["groups.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["receiver_id"],
+            ["users.id"],
+        ),
+        sa.PrimaryKeyConstraint("group_id", "giver_id"),
+        sa.UniqueConstraint("channel_id"),
+    )
+
+    # Backfill with whatever all_latest_pairs_view would have shown
+    op.execute(
+        """
+        INSERT INTO latest_pairs (
+            group_id,
+            giver_id,
+            receiver_id,
+            channel_id,
+            giver_username,
+            receiver_username,
+            group_name,
+            created_at
+        )
+        SELECT
+            group_id,
+            giver_id,
+            receiver_id,
+            channel_id,
+            giver_username,
+            receiver_username,
+            group_name,
+            created_at
+        FROM (
+            SELECT
+                a.group_id,
+                a.giver_id,
+                a.receiver_id,
+                a.channel_id,
+                c.username AS giver_username,
+                b.username AS receiver_username,
+                d.name AS group_name,
+                a.timestamp AS created_at,
+                RANK() OVER (PARTITION BY a.group_id ORDER BY a.timestamp DESC) AS r
+            FROM pairs a
+            INNER JOIN users b ON a.receiver_id = b.id
+            INNER JOIN users c ON a.giver_id = c.id
+            INNER JOIN groups d ON a.group_id = d.id
+        ) ranked
+        WHERE r = 1
+        ON CONFLICT DO NOTHING
+        """
+    )
+
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS all_latest_pairs_view")
+
+
+def downgrade():
+    # all_latest_pairs_view gets recreated lazily on the next insert into pairs
+    op.drop_table("latest_pairs")
@@ -0,0 +1,58 @@
+"""tasks payload jsonb and lookup indexes
+
+Revision ID: 9d2f5b7e1a64
+Revises: 4a9b6e2d8c13
+Create Date: 2026-10-18 21:02:47.913520
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "9d2f5b7e1a64"
+down_revision = "4a9b6e2d8c13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column(
+        "tasks",
+        "payload",
+        type_=postgresql.JSONB(astext_type=sa.Text()),
+        existing_type=sa.JSON(),
+        postgresql_using="payload::jsonb",
+    )
+    op.create_index(
+        "ix_tasks_name_status_started_at",
+        "tasks",
+        ["name", "status", "started_at"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tasks_name_payload_email",
+        "tasks",
+        ["name", sa.text("(payload ->> 'email')"), "started_at"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tasks_name_payload_group_id",
+        "tasks",
+        ["name", sa.text("(payload ->> 'group_id')")],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_tasks_name_payload_group_id", table_name="tasks")
+    op.drop_index("ix_tasks_name_payload_email", table_name="tasks")
+    op.drop_index("ix_tasks_name_status_started_at", table_name="tasks")
+    op.alter_column(
+        "tasks",
+        "payload",
+        type_=sa.JSON(),
+        existing_type=postgresql.JSONB(astext_type=sa.Text()),
+        postgresql_using="payload::json",
+    )
@@ -0,0 +1,75 @@
+"""stable keys for all_admin_view
+
+Revision ID: c1e8d4f7a2b9
+Revises: 7f3c2a9d41b6
+Create Date: 2026-10-18 20:02:47.530911
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c1e8d4f7a2b9"
+down_revision = "7f3c2a9d41b6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows used to be keyed on uuid_generate_v4(), so every concurrent refresh rewrote the whole view
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS all_admin_view")
+    op.execute(
+        """
+        CREATE MATERIALIZED VIEW all_admin_view AS (
+            WITH admins AS
+                (
+                    SELECT
+                        user_id,
+                        group_id
+                    FROM groups_and_users
+                    WHERE group_admin = 't'
+                )   SELECT
+                        user_id,
+                        username,
+                        group_id,
+                        groups.name AS groupname
+                    FROM users
+                    INNER JOIN admins
+                        ON users.id = admins.user_id
+                    INNER JOIN groups
+                        ON groups.id = admins.group_id
+        )
+        """
+    )
+    op.execute("CREATE UNIQUE INDEX ON all_admin_view (user_id, group_id)")
+
+
+def downgrade():
+    # Back to the uuid keyed view the previous revision's code expects
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS all_admin_view")
+    op.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+    op.execute(
+        """
+        CREATE MATERIALIZED VIEW all_admin_view AS (
+            WITH admins AS
+                (
+                    SELECT
+                        user_id,
+                        group_id
+                    FROM groups_and_users
+                    WHERE group_admin = 't'
+                )   SELECT
+                        uuid_generate_v4() AS id,
+                        user_id,
+                        username,
+                        group_id,
+                        groups.name AS groupname
+                    FROM users
+                    INNER JOIN admins
+                        ON users.id = admins.user_id
+                    INNER JOIN groups
+                        ON groups.id = admins.group_id
+        )
+        """
+    )
+    op.execute("CREATE UNIQUE INDEX ON all_admin_view (id)")
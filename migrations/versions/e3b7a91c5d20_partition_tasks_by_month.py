@@ -0,0 +1,115 @@
+"""partition tasks by month
+
+Revision ID: e3b7a91c5d20
+Revises: 9d2f5b7e1a64
+Create Date: 2026-10-18 21:48:13.204871
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e3b7a91c5d20"
+down_revision = "9d2f5b7e1a64"
+branch_labels = None
+depends_on = None
+
+# Keep in sync with models.task_partitions
+PREMAKE_MONTHS = 3
+
+INDEXES = (
+    "CREATE INDEX ix_tasks_name_status_started_at ON tasks (name, status, started_at)",
+    "CREATE INDEX ix_tasks_name_payload_email ON tasks (name, (payload ->> 'email'), started_at)",
+    "CREATE INDEX ix_tasks_name_payload_group_id ON tasks (name, (payload ->> 'group_id'))",
+)
+
+
+def _swap_out_old_table():
+    op.execute("ALTER TABLE tasks RENAME TO tasks_old")
+    op.execute("ALTER INDEX tasks_pkey RENAME TO tasks_old_pkey")
+    op.execute("DROP INDEX ix_tasks_name_status_started_at")
+    op.execute("DROP INDEX ix_tasks_name_payload_email")
+    op.execute("DROP INDEX ix_tasks_name_payload_group_id")
+
+
+def _move_rows_and_drop_old_table():
+    op.execute(
+        "INSERT INTO tasks (id, name, payload, error, started_at, finished_at, status) "
+        "SELECT id, name, payload, error, COALESCE(started_at, finished_at, now()), finished_at, status "
+        "FROM tasks_old"
+    )
+    op.execute("ALTER SEQUENCE tasks_id_seq OWNED BY tasks.id")
+    op.execute("DROP TABLE tasks_old")
+
+
+def upgrade():
+    _swap_out_old_table()
+
+    op.execute(
+        """
+        CREATE TABLE tasks (
+            id INTEGER NOT NULL DEFAULT nextval('tasks_id_seq'::regclass),
+            name VARCHAR(200),
+            payload JSONB,
+            error TEXT,
+            started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP WITHOUT TIME ZONE,
+            status taskstatus,
+            PRIMARY KEY (id, started_at)
+        ) PARTITION BY RANGE (started_at)
+        """
+    )
+
+    # One partition for every month that already has rows, up to a few months from now
+    op.execute(
+        f"""
+        DO $$
+        DECLARE
+            month DATE;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', LEAST(
+                        (SELECT min(COALESCE(started_at, finished_at)) FROM tasks_old), now()
+                    )),
+                    date_trunc('month', now()) + interval '{PREMAKE_MONTHS} months',
+                    interval '1 month'
+                )::date
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE tasks_%s PARTITION OF tasks FOR VALUES FROM (%L) TO (%L)',
+                    to_char(month, 'YYYY_MM'), month, month + interval '1 month'
+                );
+            END LOOP;
+        END $$
+        """
+    )
+
+    for index in INDEXES:
+        op.execute(index)
+
+    _move_rows_and_drop_old_table()
+
+
+def downgrade():
+    _swap_out_old_table()
+
+    op.execute(
+        """
+        CREATE TABLE tasks (
+            id INTEGER NOT NULL DEFAULT nextval('tasks_id_seq'::regclass),
+            name VARCHAR(200),
+            payload JSONB,
+            error TEXT,
+            started_at TIMESTAMP WITHOUT TIME ZONE,
+            finished_at TIMESTAMP WITHOUT TIME ZONE,
+            status taskstatus,
+            PRIMARY KEY (id)
+        )
+        """
+    )
+
+    for index in INDEXES:
+        op.execute(index)
+
+    _move_rows_and_drop_old_table()
@@ -6,3 +6,27 @@ class dbMixin(object):
     def delete_from_db(self, db):
         db.session.delete(self)
         db.session.commit()
+
+    @classmethod
+    def bulk_save_to_db(cls, db, rows, commit=True):
+        # One multi-row INSERT. This skips ORM events (after_insert hooks etc)
+        # so callers are responsible for anything those hooks would have done
+        if rows:
+            db.session.execute(cls.__table__.insert().values(rows))
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def page(cls, query, after=None, before=None, limit=50):
+        # Keyset pagination on the primary key. `after` walks forward from the last row the
+        # client has seen, `before` walks back from the oldest one. With neither we return the
+        # newest `limit` rows. Rows always come back oldest first, plus whether there are more
+        # in the direction we walked
+        if after is not None:
+            rows = query.filter(cls.id > after).order_by(cls.id).limit(limit + 1).all()
+            return rows[:limit], len(rows) > limit
+
+        if before is not None:
+            query = query.filter(cls.id < before)
+        rows = query.order_by(cls.id.desc()).limit(limit + 1).all()
+        return rows[:limit][::-1], len(rows) > limit
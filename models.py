@@ -1,5 +1,7 @@
+import os
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from uuid import uuid4
 
 from flask_login import UserMixin
@@ -8,17 +10,25 @@ from passlib.hash import pbkdf2_sha256
 from sqlalchemy import (
     TEXT,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.orm import object_session
 from sqlalchemy.sql import func
 
 from mixins import dbMixin
-from sql.materialized_views import AllAdminView, AllLatestPairsView
+from sql.materialized_views import AllAdminView
+from sql.idempotency import IdempotencyKeys
+from sql.materialized_views.scheduler import refresh_scheduler
+from sql.partitions import MonthlyPartitions
 
 db = SQLAlchemy()
 
 
-all_admin_materialized_view = AllAdminView(db)
-all_latest_pairs_view = AllLatestPairsView(db)
+def avatar_url(username):
+    # Avatars only depend on the username, so code that reads plain rows doesn't need a User
+    return f"https://api.dicebear.com/7.x/adventurer/svg?seed={username}"
+
+
+all_admin_materialized_view = AllAdminView(db, scheduler=refresh_scheduler)
 
 
 class OAuthProviderEnum(Enum):
@@ -90,7 +100,7 @@ class User(dbMixin, UserMixin, db.Model):
 
     @property
     def avatar_url(self):
-        return f"https://api.dicebear.com/7.x/adventurer/svg?seed={self.username}"
+        return avatar_url(self.username)
 
     def __str__(self):
         return self.email
@@ -144,6 +154,10 @@ class Group(dbMixin, UserMixin, db.Model):
 
 class GroupMessage(dbMixin, UserMixin, db.Model):
     __tablename__ = "group_messages"
+    __table_args__ = (
+        # app.group_message pages through a group's chat by id
+        db.Index("ix_group_messages_group_id_id", "group_id", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     group_id = db.Column(db.Integer, db.ForeignKey("groups.id"))
@@ -155,6 +169,23 @@ class GroupMessage(dbMixin, UserMixin, db.Model):
         db.DateTime, default=func.current_timestamp(), onupdate=datetime.now
     )
 
+    @classmethod
+    def history(cls, group_id):
+        # A group's chat as plain rows with the sender joined in, instead of GroupMessage
+        # objects that lazy load their sender one message at a time
+        return (
+            db.session.query(
+                cls.id,
+                User.username,
+                User.first_name,
+                cls.text,
+                cls.created_at,
+                cls.sender_id,
+            )
+            .join(User, User.id == cls.sender_id)
+            .filter(cls.group_id == group_id)
+        )
+
     def __str__(self):
         return f"{self.group.name} -> {self.created_at}"
 
@@ -191,6 +222,64 @@ class Pair(dbMixin, UserMixin, db.Model):
     giver = db.relationship("User", foreign_keys=[giver_id])
     receiver = db.relationship("User", foreign_keys=[receiver_id])
 
+    @classmethod
+    @lru_cache(maxsize=4096)
+    def participants(cls, channel_id):
+        # (giver_id, receiver_id) of a private channel. They never change once a pair is drawn,
+        # so every process looks them up once instead of on every poll of the chat. Unknown
+        # channels raise LookupError, which lru_cache doesn't remember
+        participants = (
+            db.session.query(cls.giver_id, cls.receiver_id)
+            .filter(cls.channel_id == channel_id)
+            .first()
+        )
+        if participants is None:
+            raise LookupError(f"No pair with channel {channel_id}")
+        return tuple(participants)
+
+
+class LatestPair(dbMixin, db.Model):
+    # The latest draw of every group, one row per giver. This used to be the all_latest_pairs_view
+    # materialized view, which re-ranked the entire pairs history on every refresh. Now a draw just
+    # swaps out its own group's rows in the same transaction that inserts the pairs
+
+    __tablename__ = "latest_pairs"
+    __table_args__ = (
+        # app.reveal_secret_santa
+        db.Index(
+            "ix_latest_pairs_group_name_receiver_username",
+            "group_name",
+            "receiver_username",
+        ),
+    )
+
+    group_id = db.Column(db.Integer, db.ForeignKey("groups.id"), primary_key=True)
+    giver_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    channel_id = db.Column(
+        UUID(as_uuid=True),
+        db.ForeignKey("pairs.channel_id", ondelete="CASCADE"),
+        unique=True,
+    )
+    # app.santa and app.profile look people up on either side of a pair
+    giver_username = db.Column(db.String(20), index=True)
+    receiver_username = db.Column(db.String(20), index=True)
+    group_name = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime)
+
+    def __str__(self):
+        return f"{self.group_name} : {self.giver_username} -> {self.receiver_username}"
+
+    __repr__ = __str__
+
+    @classmethod
+    def replace_group(cls, db, group_id, rows):
+        # Doesn't commit. Meant to run inside the transaction that writes the new draw
+        db.session.query(cls).filter_by(group_id=group_id).delete(
+            synchronize_session=False
+        )
+        cls.bulk_save_to_db(db, rows, commit=False)
+
 
 class PairCreationStatus(dbMixin, db.Model):
     __tablename__ = "pair_creation_statuses"
@@ -217,20 +306,134 @@ class Task(dbMixin, db.Model):
         processing = 1
         finished = 2
 
-    id = db.Column(db.Integer, primary_key=True)
+    # Range partitioned by month on started_at (see task_partitions below). Postgres wants the partition key in the
+    # primary key, but ids come from a sequence and are unique on their own, so the mapper keeps using just the id
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(200), default="unnamed_task")
-    payload = db.Column(db.JSON)
+    payload = db.Column(JSONB)
     error = db.Column(db.Text)
-    started_at = db.Column(db.DateTime)
+    started_at = db.Column(
+        db.DateTime,
+        primary_key=True,
+        nullable=False,
+        default=datetime.now,
+        server_default=func.now(),
+    )
     finished_at = db.Column(db.DateTime)
     status = db.Column(db.Enum(TaskStatus))
 
+    __table_args__ = (
+        db.Index("ix_tasks_name_status_started_at", name, status, started_at),
+        # app.reset_password
+        db.Index(
+            "ix_tasks_name_payload_email", name, payload["email"].astext, started_at
+        ),
+        # app.group (pairing in progress)
+        db.Index("ix_tasks_name_payload_group_id", name, payload["group_id"].astext),
+        {"postgresql_partition_by": "RANGE (started_at)"},
+    )
+    __mapper_args__ = {"primary_key": [id]}
+
     def __str__(self):
         return self.name
 
+    def enqueue(self, session, celery_task: str, idempotency_key: str = None):
+        # Adds this row and the outbox message that starts `celery_task` for it to the same transaction. Nothing is
+        # sent until the caller commits, and then the outbox relay picks it up (see sql/outbox.py)
+        # `idempotency_key` names the thing this task is about (a message, an invite) so the work runs once even if
+        # the message is delivered twice. Defaults to the task row itself
+        if idempotency_key:
+            self.payload = {**(self.payload or {}), "idempotency_key": idempotency_key}
+        session.add(self)
+        session.flush()
+        session.add(Outbox(task_name=celery_task, args=[self.id]))
+
+    @property
+    def idempotency_key(self):
+        return (self.payload or {}).get("idempotency_key") or f"task:{self.id}"
+
+    @classmethod
+    def find(cls, name, status=None, **payload):
+        # Payload keys are compared as (payload ->> key) = text so that postgres can use the
+        # expression indexes above. Keep the two in sync when adding a new hot key
+        query = cls.query.filter(cls.name == name)
+        if status is not None:
+            statuses = [status] if isinstance(status, str) else status
+            query = query.filter(cls.status.in_(statuses))
+        for key, value in payload.items():
+            query = query.filter(cls.payload[key].astext == str(value))
+        return query
+
+    # The web app creates the Task row and hands its id to celery. Workers fetch the row by
+    # primary key and move it along with these
+    def mark_processing(self, db):
+        self.status = "processing"
+        self.save_to_db(db)
+
+    def mark_finished(self, db, error=None):
+        self.status = "finished"
+        self.finished_at = datetime.now()
+        if error:
+            self.error = str(error)
+        self.save_to_db(db)
+
+
+class Outbox(db.Model):
+    # Celery messages waiting to be published. Rows are written in the same transaction as whatever they're about
+    # and sql.outbox.OutboxRelay sends them to the broker
+
+    __tablename__ = "outbox"
+    __table_args__ = (
+        # The relay only ever looks at unsent rows
+        db.Index("ix_outbox_unsent", "id", postgresql_where=db.text("sent_at IS NULL")),
+    )
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    task_name = db.Column(db.String(200), nullable=False)
+    args = db.Column(JSONB, nullable=False, default=list)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
+
+    def __str__(self):
+        return f"{self.task_name}{tuple(self.args)}"
+
+    __repr__ = __str__
+
+
+class IdempotencyKey(db.Model):
+    # Work that has been claimed or done, see sql.idempotency.IdempotencyKeys. Kept out of tasks so it doesn't get
+    # archived along with old task partitions
+
+    __tablename__ = "idempotency_keys"
+
+    key = db.Column(db.String(200), primary_key=True)
+    task_name = db.Column(db.String(200))
+    claimed_at = db.Column(db.DateTime, nullable=False)
+    lease_expires_at = db.Column(db.DateTime, nullable=False)
+    completed_at = db.Column(db.DateTime)
+
+
+idempotency_keys = IdempotencyKeys(
+    db,
+    broker_url=os.environ.get("CELERY_BROKER_URL"),
+    lease=int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", 15 * 60)),
+)
+
+task_partitions = MonthlyPartitions(
+    "tasks",
+    db,
+    premake=3,
+    retain=int(os.getenv("TASKS_RETAIN_MONTHS", 6)),
+    archive_dir=os.getenv("TASKS_ARCHIVE_DIR"),
+)
+
 
 class Message(dbMixin, db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        # app.santa_message and app.santee_message page through a channel by id
+        db.Index("ix_messages_pair_channel_id_id", "pair_channel_id", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     pair_channel_id = db.Column(UUID(as_uuid=True), db.ForeignKey("pairs.channel_id"))
@@ -317,19 +520,26 @@ def create_group_admin_materialized_view(mapper, connection, target):
     all_admin_materialized_view.create()
 
 
-@event.listens_for(Pair, "before_insert", once=True)
-def create_all_latest_pairs_view(mapper, connection, target):
-    all_latest_pairs_view.create()
-
-
 # "after_insert" HOOKS
+# These only note on the session that the view is out of date. Once the transaction
+# commits the view gets marked dirty, and a celery worker refreshes it at most once per
+# interval no matter how many rows were written. Rolled back writes schedule nothing
 
 
 @event.listens_for(GroupsAndUsersAssociation, "after_insert")
+@event.listens_for(GroupsAndUsersAssociation, "after_update")
+@event.listens_for(GroupsAndUsersAssociation, "after_delete")
 def refresh_group_admin_materialized_view(mapper, connection, target):
-    all_admin_materialized_view.refresh()
+    session = object_session(target)
+    session.info.setdefault("stale_views", set()).add(all_admin_materialized_view)
+
+
+@event.listens_for(db.session, "after_commit")
+def schedule_stale_view_refreshes(session):
+    for view in session.info.pop("stale_views", ()):
+        view.schedule_refresh()
 
 
-@event.listens_for(Pair, "after_insert")
-def refresh_all_latest_pairs_view(mapper, connection, target):
-    all_latest_pairs_view.refresh()
+@event.listens_for(db.session, "after_rollback")
+def forget_stale_views(session):
+    session.info.pop("stale_views", None)
@@ -0,0 +1,92 @@
+import logging
+from functools import cached_property
+from typing import Dict
+
+import redis
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyKeys:
+    """
+    Makes sure a piece of work keyed by K runs to completion at most once, no matter how often its message shows up.
+    A worker claims K before doing the work with a single INSERT ... ON CONFLICT, so only one claim can win. Completed
+    keys are never handed out again, keys whose lease ran out (the worker died halfway) can be claimed again, and work
+    that's going to be retried releases its key so the retry can claim it.
+
+    Every claim that loses is counted in the idempotency:suppressed redis hash by task name, so we can see how many
+    duplicate sends we saved
+    """
+
+    METRICS_KEY = "idempotency:suppressed"
+
+    def __init__(self, conn, broker_url: str, lease: int = 15 * 60):
+        self.conn = conn
+        self.broker_url = broker_url
+        self.lease = lease
+
+    @cached_property
+    def redis(self):
+        return redis.Redis.from_url(self.broker_url)
+
+    def claim(self, key: str, task_name: str) -> bool:
+        with self.conn.engine.begin() as connection:
+            claimed = connection.execute(
+                text(
+                    "INSERT INTO idempotency_keys (key, task_name, claimed_at, lease_expires_at) "
+                    "VALUES (:key, :task_name, now(), now() + make_interval(secs => :lease)) "
+                    "ON CONFLICT (key) DO UPDATE "
+                    "SET claimed_at = now(), lease_expires_at = EXCLUDED.lease_expires_at "
+                    "WHERE idempotency_keys.completed_at IS NULL "
+                    "AND idempotency_keys.lease_expires_at < now() "
+                    "RETURNING key"
+                ),
+                {"key": key, "task_name": task_name, "lease": self.lease},
+            ).fetchone()
+
+        if not claimed:
+            logger.info(f"Skipping {task_name} for {key}. Already done or in flight")
+            self.count_suppressed(task_name)
+        return bool(claimed)
+
+    def complete(self, key: str):
+        with self.conn.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "UPDATE idempotency_keys SET completed_at = now() WHERE key = :key"
+                ),
+                {"key": key},
+            )
+
+    def release(self, key: str):
+        with self.conn.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "DELETE FROM idempotency_keys WHERE key = :key AND completed_at IS NULL"
+                ),
+                {"key": key},
+            )
+
+    def purge(self, keep_days: int = 30):
+        with self.conn.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "DELETE FROM idempotency_keys "
+                    "WHERE completed_at < now() - make_interval(days => :keep_days)"
+                ),
+                {"keep_days": keep_days},
+            )
+
+    def count_suppressed(self, task_name: str):
+        try:
+            self.redis.hincrby(self.METRICS_KEY, task_name, 1)
+        except redis.RedisError as e:
+            # Metrics are nice to have. Never fail a task over them
+            logger.warning(f"Couldn't count suppressed duplicate: {e}")
+
+    def suppressed(self) -> Dict[str, int]:
+        return {
+            task_name.decode(): int(count)
+            for task_name, count in self.redis.hgetall(self.METRICS_KEY).items()
+        }
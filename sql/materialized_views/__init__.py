@@ -1,7 +1,7 @@
 import logging
+import redis
 from sqlalchemy.exc import ProgrammingError, NoSuchTableError
 from sqlalchemy.schema import Table, MetaData
-from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from functools import cached_property
 
@@ -9,10 +9,22 @@ logger = logging.getLogger(__name__)
 
 
 class MaterializedView:
-    def __init__(self, name, conn, ddl):
+    """
+    `key` is the set of columns that identifies a row. It has to be stable across refreshes so REFRESH ... CONCURRENTLY
+    only rewrites the rows that actually changed. It gets a unique index, which CONCURRENTLY needs anyway.
+
+    `indexes` are any other column combinations the app filters the view by. Each one gets a plain btree index
+    """
+
+    def __init__(self, name, conn, ddl, key, indexes=(), scheduler=None):
         self.name = name
         self.conn = conn
         self.ddl = ddl
+        self.key = key
+        self.indexes = indexes
+        self.scheduler = scheduler
+        if scheduler:
+            scheduler.register(self)
 
     def create(self):
         try:
@@ -24,11 +36,50 @@ class MaterializedView:
                 logger.debug(
                     f"Materialized view {self.name} already exists. Skipping creation"
                 )
+        self.ensure_indexes()
+
+    def _index_name(self, columns):
+        # Same name Postgres would have picked for an unnamed index
+        return f"{self.name}_{'_'.join(columns)}_idx"
+
+    def ensure_indexes(self):
+        statements = [
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self._index_name(self.key)} "
+            f"ON {self.name} ({', '.join(self.key)})"
+        ] + [
+            f"CREATE INDEX IF NOT EXISTS {self._index_name(columns)} "
+            f"ON {self.name} ({', '.join(columns)})"
+            for columns in self.indexes
+        ]
+        with self.conn.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(statement)
 
     def refresh(self):
         logger.debug(f"refreshing materialized view {self.name}")
-        with self.conn.engine.begin() as connection:
-            connection.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {self.name}")
+        try:
+            with self.conn.engine.begin() as connection:
+                connection.execute(
+                    f"REFRESH MATERIALIZED VIEW CONCURRENTLY {self.name}"
+                )
+        except ProgrammingError as e:
+            # Bulk inserts skip the "before_insert" hooks that usually create the view
+            if "does not exist" not in e.__str__():
+                raise
+            self.create()
+
+    def schedule_refresh(self):
+        """
+        Debounced refresh that runs in a celery worker. Falls back to refreshing right away if there's no scheduler
+        or it can't reach redis
+        """
+        if self.scheduler:
+            try:
+                self.scheduler.mark_dirty(self)
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Couldn't schedule a refresh of {self.name}: {e}")
+        self.refresh()
 
     def drop(self):
         self.conn.engine.execute(f"DROP MATERIALIZED VIEW IF EXISTS {self.name}")
@@ -37,48 +88,43 @@ class MaterializedView:
     def query(self):
         return self.conn.session.query(self._view)
 
+    def _reflect(self):
+        table = Table(
+            self.name,
+            MetaData(bind=self.conn.engine),
+            autoload_with=self.conn.engine,
+        )
+        return type(
+            self.name,
+            (declarative_base(),),
+            {
+                "__table__": table,
+                # Views don't have primary keys, so tell the mapper which columns identify a row
+                "__mapper_args__": {
+                    "primary_key": [table.c[column] for column in self.key]
+                },
+            },
+        )
+
     @cached_property
     def _view(self):
         try:
-            _table = type(
-                self.name,
-                (declarative_base(),),
-                {
-                    "__table__": Table(
-                        self.name,
-                        MetaData(bind=self.conn.engine),
-                        self.conn.Column("id", UUID(as_uuid=True), primary_key=True),
-                        autoload_with=self.conn.engine,
-                    )
-                },
-            )
+            _table = self._reflect()
 
         except NoSuchTableError:
             self.create()
-            _table = type(
-                self.name,
-                (declarative_base(),),
-                {
-                    "__table__": Table(
-                        self.name,
-                        MetaData(bind=self.conn.engine),
-                        self.conn.Column("id", UUID(as_uuid=True), primary_key=True),
-                        autoload_with=self.conn.engine,
-                    )
-                },
-            )
+            _table = self._reflect()
         return _table
 
 
 class AllAdminView(MaterializedView):
-    def __init__(self, conn):
+    def __init__(self, conn, scheduler=None):
         from .all_admin_view import ddl
 
-        super().__init__("all_admin_view", conn, ddl)
-
-
-class AllLatestPairsView(MaterializedView):
-    def __init__(self, conn):
-        from .all_latest_pairs_view import ddl
-
-        super().__init__("all_latest_pairs_view", conn, ddl)
+        super().__init__(
+            "all_admin_view",
+            conn,
+            ddl,
+            key=("user_id", "group_id"),
+            scheduler=scheduler,
+        )
@@ -1,4 +1,3 @@
-CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 CREATE MATERIALIZED VIEW all_admin_view AS (
     WITH admins AS
         (
@@ -8,7 +7,6 @@ CREATE MATERIALIZED VIEW all_admin_view AS (
             FROM groups_and_users
             WHERE group_admin = 't'
         )   SELECT 
-                uuid_generate_v4() AS id,
                 user_id,
                 username,
                 group_id,
@@ -18,6 +16,4 @@ CREATE MATERIALIZED VIEW all_admin_view AS (
                 ON users.id = admins.user_id
             INNER JOIN groups
                 ON groups.id = admins.group_id
-);
-
-CREATE UNIQUE INDEX ON all_admin_view (id);
\ No newline at end of file
+);
\ No newline at end of file
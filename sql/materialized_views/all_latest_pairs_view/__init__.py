@@ -1 +0,0 @@
-from .ddl import ddl
@@ -0,0 +1,64 @@
+import logging
+import os
+from functools import cached_property
+
+import redis
+from celery import Celery
+
+logger = logging.getLogger(__name__)
+
+REFRESH_TASK = "view.refresh_materialized_view"
+
+
+class RefreshScheduler:
+    """
+    Coalesces bursts of materialized view refreshes into one refresh per interval. The first mark in an interval sets
+    a flag in redis and queues a delayed celery task, and every other mark inside that interval sees the flag and does
+    nothing. The task clears the flag before refreshing, so writes that land mid-refresh schedule another one.
+
+    Callers that need to read their own writes right away should call `view.refresh()` directly instead
+    """
+
+    def __init__(self, broker_url: str, interval: float = 2):
+        self.broker_url = broker_url
+        self.interval = interval
+        self.views = {}
+
+    @cached_property
+    def redis(self):
+        return redis.Redis.from_url(self.broker_url)
+
+    @cached_property
+    def celery(self):
+        celery = Celery("tasks", broker=self.broker_url)
+        celery.config_from_object("celery_config")
+        return celery
+
+    def register(self, view):
+        self.views[view.name] = view
+
+    def _flag(self, name: str) -> str:
+        return f"materialized_view:{name}:dirty"
+
+    def mark_dirty(self, view):
+        # The flag expires on its own in case the refresh task ever gets lost
+        if self.redis.set(
+            self._flag(view.name), 1, nx=True, ex=max(int(self.interval * 10), 60)
+        ):
+            logger.debug(
+                f"scheduling refresh of {view.name} in {self.interval} seconds"
+            )
+            self.celery.send_task(REFRESH_TASK, (view.name,), countdown=self.interval)
+
+    def refresh(self, name: str):
+        """
+        Runs in the celery worker
+        """
+        self.redis.delete(self._flag(name))
+        self.views[name].refresh()
+
+
+refresh_scheduler = RefreshScheduler(
+    broker_url=os.environ.get("CELERY_BROKER_URL"),
+    interval=float(os.getenv("MATERIALIZED_VIEW_REFRESH_INTERVAL", 2)),
+)
@@ -0,0 +1,84 @@
+import logging
+from time import sleep
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """
+    Publishes outbox rows to the broker after the transaction that wrote them has committed. Web requests write an
+    outbox row next to the Task row it's about, in the same transaction, so either both exist or neither does. The
+    relay claims a batch of unsent rows with FOR UPDATE SKIP LOCKED (so you can run more than one), publishes them
+    over a single producer connection, marks them sent and commits.
+
+    Delivery is at least once. If the relay dies between publishing and committing, the batch is published again by
+    whoever picks it up next. `table` is only ever something else in tests, which relay from a copy of outbox
+    """
+
+    def __init__(
+        self,
+        conn,
+        celery,
+        batch_size: int = 500,
+        poll_interval: float = 0.5,
+        keep_sent_for: str = "1 day",
+        table: str = "outbox",
+    ):
+        self.conn = conn
+        self.celery = celery
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.keep_sent_for = keep_sent_for
+        self.table = table
+
+    def relay_batch(self) -> int:
+        with self.conn.engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    f"SELECT id, task_name, args FROM {self.table} WHERE sent_at IS NULL "
+                    "ORDER BY id LIMIT :batch_size FOR UPDATE SKIP LOCKED"
+                ),
+                {"batch_size": self.batch_size},
+            ).fetchall()
+            if not rows:
+                return 0
+
+            with self.celery.producer_or_acquire() as producer:
+                for _, task_name, args in rows:
+                    self.celery.send_task(task_name, tuple(args), producer=producer)
+
+            connection.execute(
+                text(f"UPDATE {self.table} SET sent_at = now() WHERE id = ANY(:ids)"),
+                {"ids": [row[0] for row in rows]},
+            )
+
+        logger.debug(f"relayed {len(rows)} outbox messages")
+        return len(rows)
+
+    def purge(self):
+        with self.conn.engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"DELETE FROM {self.table} "
+                    "WHERE sent_at < now() - CAST(:keep AS interval)"
+                ),
+                {"keep": self.keep_sent_for},
+            )
+
+    def run(self):
+        logger.info(f"relaying outbox in batches of {self.batch_size}")
+        idle = 0
+        while True:
+            try:
+                # A full batch means there's probably more waiting, so go again right away
+                if self.relay_batch() == self.batch_size:
+                    continue
+            except Exception as e:
+                logger.exception(f"Failed to relay outbox batch: {e}")
+
+            idle += 1
+            if idle % 1000 == 0:
+                self.purge()
+            sleep(self.poll_interval)
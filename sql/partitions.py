@@ -0,0 +1,125 @@
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+class MonthlyPartitions:
+    """
+    Maintains a table that is range partitioned by month on a timestamp column. Every partition is named
+    {table}_YYYY_MM and covers [first of that month, first of the next month).
+
+    `maintain` creates the next `premake` months ahead of time so inserts never land outside of a partition, and
+    detaches every partition that ended more than `retain` months ago. Detached partitions are written to `archive_dir`
+    as gzipped CSV and dropped, or left around as plain tables without an `archive_dir`. Safe to run as often as you
+    like
+    """
+
+    def __init__(
+        self,
+        table: str,
+        conn,
+        premake: int = 3,
+        retain: int = 6,
+        archive_dir: Optional[str] = None,
+    ):
+        self.table = table
+        self.conn = conn
+        self.premake = premake
+        self.retain = retain
+        self.archive_dir = archive_dir
+        self.pattern = re.compile(rf"\A{table}_(\d{{4}})_(\d{{2}})\Z")
+
+    def partition_name(self, month: date) -> str:
+        return f"{self.table}_{month:%Y_%m}"
+
+    def _month(self, name: str) -> date:
+        year, month = self.pattern.match(name).groups()
+        return date(int(year), int(month), 1)
+
+    def _partitions(self, attached: bool) -> List[str]:
+        with self.conn.engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT relname FROM pg_class "
+                    "WHERE relkind = 'r' AND relispartition = :attached AND relname LIKE :prefix"
+                ),
+                {"attached": attached, "prefix": f"{self.table}\\_%"},
+            )
+            names = [row[0] for row in rows]
+        return sorted(name for name in names if self.pattern.match(name))
+
+    def partitions(self) -> List[str]:
+        return self._partitions(attached=True)
+
+    def detached(self) -> List[str]:
+        return self._partitions(attached=False)
+
+    def create(self, month: date):
+        name = self.partition_name(month)
+        logger.info(f"creating partition {name}")
+        with self.conn.engine.begin() as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.table} "
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+            )
+
+    def create_upcoming(self, today: Optional[date] = None):
+        this_month = (today or datetime.now().date()).replace(day=1)
+        for months in range(self.premake + 1):
+            self.create(add_months(this_month, months))
+
+    def expired(self, today: Optional[date] = None) -> List[str]:
+        this_month = (today or datetime.now().date()).replace(day=1)
+        cutoff = add_months(this_month, -self.retain)
+        return [name for name in self.partitions() if self._month(name) < cutoff]
+
+    def detach(self, name: str):
+        logger.info(f"detaching partition {name}")
+        with self.conn.engine.begin() as connection:
+            connection.execute(f"ALTER TABLE {self.table} DETACH PARTITION {name}")
+
+    def archive(self, name: str) -> str:
+        """
+        Streams a detached partition into {archive_dir}/{name}.csv.gz and drops it. The file is written under a
+        temporary name first so a half written archive never looks finished
+        """
+        path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        connection = self.conn.engine.raw_connection()
+        try:
+            with gzip.open(f"{path}.part", "wb") as archive:
+                cursor = connection.cursor()
+                cursor.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", archive)
+            os.replace(f"{path}.part", path)
+
+            cursor.execute(f"DROP TABLE {name}")
+            connection.commit()
+        finally:
+            connection.close()
+
+        logger.info(f"archived partition {name} to {path}")
+        return path
+
+    def maintain(self, today: Optional[date] = None):
+        self.create_upcoming(today)
+
+        for name in self.expired(today):
+            self.detach(name)
+
+        if self.archive_dir:
+            # Also picks up partitions that were detached by a run that failed halfway
+            for name in self.detached():
+                self.archive(name)
@@ -6,35 +6,82 @@ import sys
 from datetime import datetime
 from functools import wraps
 from random import uniform
-from time import sleep, time
+from time import sleep
 from typing import Dict, Tuple
 from uuid import uuid4
 
-import requests
 import sentry_sdk
-from aiohttp import ClientSession
 from aiohttp.client_exceptions import ClientConnectionError
 from aiohttp.web import HTTPException, HTTPServerError
-from celery import Celery
+from celery import Celery, current_task
+from celery.exceptions import Ignore
+from celery.schedules import crontab
+from celery.signals import worker_init
+from gevent.pool import Pool
+from psycogreen.gevent import patch_psycopg
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 from sqlalchemy import and_, func, select
 from sqlalchemy.orm import aliased
 
+import celery_config
 from app import app
-from app import celery as app_celery
 from app import db
-from models import Group, Pair, Task, User, all_latest_pairs_view
-
-celery = Celery("tasks", broker=os.environ.get("CELERY_BROKER_URL"))
-
-celery.conf.task_routes = {
-    "pair.*": {"queue": "pairs_queue"},
-    "user.*": {"queue": "users_queue"},
+from lib.concurrency.fanout import FanOutResult
+from lib.entropy.pool import EntropyPool
+from lib.entropy.sources import QRNGSource
+from lib.http.client import http_client
+from lib.ratelimit.token_bucket import EmailRateLimiter, RateLimited, TokenBuckets
+from lib.pairing.cycle import PairingInfeasible, PairingSearchExhausted, SingleCycle
+from models import (
+    Group,
+    GroupsAndUsersAssociation,
+    LatestPair,
+    Pair,
+    Task,
+    User,
+    idempotency_keys,
+    task_partitions,
+)
+from sql.materialized_views.scheduler import REFRESH_TASK, refresh_scheduler
+
+celery = Celery("tasks")
+celery.config_from_object("celery_config")
+
+celery.conf.beat_schedule = {
+    "maintain-task-partitions": {
+        "task": "maintenance.maintain_task_partitions",
+        "schedule": crontab(hour=3, minute=0),
+    },
+    "purge-idempotency-keys": {
+        "task": "maintenance.purge_idempotency_keys",
+        "schedule": crontab(hour=3, minute=30),
+    },
 }
 
 
 logger = logging.getLogger(__name__)
 
+
+@worker_init.connect
+def setup_gevent_pool(**kwargs):
+    if celery_config.worker_pool != "gevent":
+        return
+    # psycopg2 blocks the whole process on every query unless it's told to hand control to
+    # the other greenlets while it waits on postgres
+    patch_psycopg()
+    # Greenlets that want a connection while all of them are in use wait for one (up to
+    # pool_timeout) rather than each opening their own, since postgres' max_connections is
+    # shared with everything else. The engine is only created on first use, so this still applies
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.getenv("USERS_WORKER_DB_POOL_SIZE", 15)),
+        "max_overflow": 0,
+        "pool_timeout": 60,
+    }
+
+
+# Random weights for pairing. One pool per worker process
+entropy_pool = EntropyPool(QRNGSource())
+
 # sentry
 if os.getenv("ENV") == "production":
     sentry_sdk.init(
@@ -51,11 +98,26 @@ if os.getenv("ENV") == "production":
     )
 
 
+MAILGUN_API_URL = os.getenv("MAILGUN_API_URL", "https://api.mailgun.net/v3")
+
+# Shared by every worker through redis. Provider limits are in API calls per second, domain limits in recipients per
+# second for each recipient domain
+mail_rate_limiter = EmailRateLimiter(
+    TokenBuckets(broker_url=os.environ.get("CELERY_BROKER_URL")),
+    provider="mailgun",
+    provider_rate=float(os.getenv("MAILGUN_RATE_LIMIT", 50)),
+    provider_burst=float(os.getenv("MAILGUN_RATE_BURST", 100)),
+    domain_rate=float(os.getenv("EMAIL_DOMAIN_RATE_LIMIT", 20)),
+    domain_burst=float(os.getenv("EMAIL_DOMAIN_RATE_BURST", 1000)),
+)
+
+
 def send_email(to: str, subject: str, template_name: str, payload: Dict):
     if mailgun_api_key := os.getenv("MAILGUN_API_KEY"):
         domain_name = "www.mysecretsanta.io"
-        response = requests.post(
-            f"https://api.mailgun.net/v3/{domain_name}/messages",
+        mail_rate_limiter.check(to)
+        response = http_client.post(
+            f"{MAILGUN_API_URL}/{domain_name}/messages",
             auth=("api", mailgun_api_key),
             data={
                 "from": f"MySecretSanta <no-reply@{domain_name}>",
@@ -69,10 +131,58 @@ def send_email(to: str, subject: str, template_name: str, payload: Dict):
         logger.debug(response.status_code)
         logger.debug(response.content)
         logger.debug(response.headers)
+        return response
     else:
         logger.debug(f"pretending to send and email to {to}")
 
 
+# Mailgun won't take more recipients than this in one message
+MAILGUN_BATCH_SIZE = 1000
+
+
+def send_batch_email(
+    recipients: Dict[str, Dict], subject: str, template_name: str, payload: Dict
+):
+    """
+    Sends the same template to up to MAILGUN_BATCH_SIZE people in one request. `recipients` maps every address to its
+    own variables, which Mailgun fills in from recipient-variables. Each recipient still gets their own email and
+    doesn't see anybody else in "to"
+    """
+    if len(recipients) > MAILGUN_BATCH_SIZE:
+        raise ValueError(
+            f"Can't send to more than {MAILGUN_BATCH_SIZE} recipients at once"
+        )
+
+    if mailgun_api_key := os.getenv("MAILGUN_API_KEY"):
+        domain_name = "www.mysecretsanta.io"
+        per_recipient = {key for variables in recipients.values() for key in variables}
+        mail_rate_limiter.check(recipients)
+        response = http_client.post(
+            f"{MAILGUN_API_URL}/{domain_name}/messages",
+            auth=("api", mailgun_api_key),
+            data={
+                "from": f"MySecretSanta <no-reply@{domain_name}>",
+                "to": list(recipients),
+                "template": template_name,
+                "recipient-variables": json.dumps(recipients),
+                "h:X-Mailgun-Variables": json.dumps(
+                    {
+                        **payload,
+                        **{key: f"%recipient.{key}%" for key in per_recipient},
+                    }
+                ),
+                "subject": subject,
+            },
+        )
+
+        logger.debug(response.status_code)
+        logger.debug(response.content)
+        # The whole batch goes out or none of it does, so let the retry decorator have it
+        response.raise_for_status()
+    else:
+        logger.debug(f"pretending to send an email to {len(recipients)} recipients")
+
+
 # This is just a wrapper class for the retry decorator. Whenever we get an instance of this class it means something went wrong
 # in the retry process
 class RetryException:
@@ -85,6 +195,15 @@ class RetryException:
     __repr__ = __str__
 
 
+# Redis redelivers a message that hasn't been acked within its visibility timeout (1 hour by default),
+# and a worker holds on to countdown/ETA messages unacked. Keep backoffs well under that
+MAX_BACKOFF = 30 * 60
+
+
+def backoff(retries: int) -> float:
+    return min(2**retries + uniform(1, 2), MAX_BACKOFF)
+
+
 def retry(exceptions: Tuple, max_retries: int = 3):
     """
     Create retry decorators by passing a list/tuple of exceptions. Can also set max number of retries
@@ -95,8 +214,68 @@ def retry(exceptions: Tuple, max_retries: int = 3):
         @arithmetic_exception_retry
         def _calculate_center_of_gravity(mass):
             ...
+
+    Inside a celery worker we never sleep. The whole task that called the decorated function is sent back to the
+    broker with a countdown (task.retry) and the worker moves on to the next message. The attempt count travels with
+    the message (request.retries), so it survives the round trip. Outside a worker (called directly, shell etc)
+    we just sleep and try again in place
     """
 
+    def _handle_failure(f, e, retries):
+        # Returns a RetryException if we should give up, raises celery's Retry if the broker is taking over,
+        # otherwise returns how long to sleep before trying again in place
+        task = current_task
+        in_worker = bool(task) and not task.request.called_directly
+
+        # Being rate limited isn't a failure. Come back when there are tokens again, however many times it takes.
+        # The copy keeps the current attempt count so waiting doesn't eat into max_retries
+        if isinstance(e, RateLimited):
+            if in_worker:
+                logger.info(
+                    f"{task.name} is rate limited. Rescheduling in {e.wait:.2f}s"
+                )
+                task.apply_async(
+                    args=task.request.args,
+                    kwargs=task.request.kwargs,
+                    countdown=e.wait,
+                    retries=task.request.retries,
+                )
+                raise Ignore()
+            return e.wait
+
+        # If we get an exception that we're not sure about, we simply catch it and log the error in the db
+        if not isinstance(e, exceptions):
+            return RetryException(
+                f"""
+            Caught an unknown exception while executing {f.__name__}. Refraining from retries
+            {e}
+            """
+            )
+
+        if in_worker:
+            retries = task.request.retries + 1
+
+        if retries >= max_retries:
+            return RetryException(
+                f"""
+            Failed to execute {f.__name__} despite exponential backoff
+            {e}
+            """
+            )
+
+        total_backoff = backoff(retries)
+        if in_worker:
+            logger.warning(
+                f"Retrying {task.name} because {f.__name__} failed (#{retries}). Rescheduling in {total_backoff}s"
+            )
+            raise task.retry(exc=e, countdown=total_backoff, max_retries=max_retries)
+
+        sys.stderr.write(
+            f"Retrying {f.__name__} #{retries}. Sleeping for {total_backoff}s"
+        )
+        sys.stderr.flush()
+        return total_backoff
+
     def _retry(f):
         @wraps(f)
         def _f_with_retries(*args, **kwargs):
@@ -105,31 +284,11 @@ def retry(exceptions: Tuple, max_retries: int = 3):
                 try:
                     return f(*args, **kwargs)
                 except Exception as e:
-                    # If we get an exception that we're not sure about, we simply catch it and log the error in the db
-                    if type(e) not in exceptions:
-                        return RetryException(
-                            f"""
-                        Caught an unknown exception while executing {f.__name__}. Refraining from retries
-                        {e}
-                        """
-                        )
                     retries += 1
-                    if retries == max_retries:
-                        return RetryException(
-                            f"""
-                        Failed to execute {f.__name__} despite exponential backoff
-                        {e}
-                        """
-                        )
-                    else:
-                        backoff_interval = 2**retries
-                        jitter = uniform(1, 2)
-                        total_backoff = backoff_interval + jitter
-                        sys.stderr.write(
-                            f"Retrying {f.__name__} #{retries}. Sleeping for {total_backoff}s"
-                        )
-                        sys.stderr.flush()
-                        sleep(total_backoff)
+                    outcome = _handle_failure(f, e, retries)
+                    if isinstance(outcome, RetryException):
+                        return outcome
+                    sleep(outcome)
 
         @wraps(f)
         async def _async_f_with_retries(*args, **kwargs):
@@ -138,31 +297,11 @@ def retry(exceptions: Tuple, max_retries: int = 3):
                 try:
                     return await f(*args, **kwargs)
                 except Exception as e:
-                    # If we get an exception that we're not sure about, we simply catch it and log the error in the db
-                    if type(e) not in exceptions:
-                        return RetryException(
-                            f"""
-                        Caught an unknown exception. Refraining from retries
-                        {e}
-                        """
-                        )
                     retries += 1
-                    if retries == max_retries:
-                        return RetryException(
-                            f"""
-                        Failed to execute {f.__name__} despite exponential backoff
-                        {e}
-                        """
-                        )
-                    else:
-                        backoff_interval = 2**retries
-                        jitter = uniform(1, 2)
-                        total_backoff = backoff_interval + jitter
-                        sys.stderr.write(
-                            f"Retrying {f.__name__} #{retries}. Sleeping for {total_backoff}s"
-                        )
-                        sys.stderr.flush()
-                        asyncio.sleep(total_backoff)
+                    outcome = _handle_failure(f, e, retries)
+                    if isinstance(outcome, RetryException):
+                        return outcome
+                    await asyncio.sleep(outcome)
 
         if asyncio.iscoroutinefunction(f):
             return _async_f_with_retries
@@ -172,53 +311,65 @@ def retry(exceptions: Tuple, max_retries: int = 3):
     return _retry
 
 
-network_exception_retry = retry(
-    exceptions=(
-        HTTPError,
-        ConnectionError,
-        ClientConnectionError,
-        Timeout,
-        HTTPException,
-        HTTPServerError,
-    ),
-    max_retries=12,
+def idempotent(f):
+    """
+    For celery tasks that take a Task id. Claims the task's idempotency key before running it and skips the run
+    entirely if somebody else already did (or is doing) the same work, e.g. when the broker redelivers a message.
+    If the run blows up, including celery's Retry when the task is rescheduled, the key is released so the next
+    attempt can claim it
+    """
+
+    @wraps(f)
+    def _f(task_id):
+        with app.app_context():
+            task = Task.query.get(task_id)
+            key = task.idempotency_key
+            if not idempotency_keys.claim(key, task.name):
+                return
+
+            try:
+                result = f(task_id)
+            except BaseException:
+                idempotency_keys.release(key)
+                raise
+
+            idempotency_keys.complete(key)
+            return result
+
+    return _f
+
+
+NETWORK_EXCEPTIONS = (
+    HTTPError,
+    ConnectionError,
+    ClientConnectionError,
+    Timeout,
+    HTTPException,
+    HTTPServerError,
 )
 
+network_exception_retry = retry(exceptions=NETWORK_EXCEPTIONS, max_retries=12)
+
 
 @network_exception_retry
 async def _make_pairs_async(pipe={}):
     group_id = pipe["group_id"]
     with app.app_context():
         group = Group.query.filter_by(id=group_id).first()
-        weighted_set = []
-
-        async def grab_random_number_for_user(session):
-            import json
-
-            epoch = int(time())
-            url = f"https://qrng.anu.edu.au/wp-content/plugins/colours-plugin/get_one_binary.php?_={epoch}"
-            resp = await session.request(method="GET", url=url)
-            resp.raise_for_status()
-            number = int(await resp.text(), 2)
-            return number
-
-        async def add_weight_to_user(user, session):
-            logger.debug(f"Grabbing random number for {user}")
-            random_number = await grab_random_number_for_user(session)
-            logger.debug(f"The quantuam random machine said {random_number}")
-            weighted_set.append((user, random_number))
-
-        async with ClientSession() as session:
-            tasks = []
-            for user_association in group.users:
-                if user_association.participating:
-                    user = user_association.user
-                    tasks.append(add_weight_to_user(user, session))
-                else:
-                    logger.debug(
-                        f"Skipping user {user_association.user} because they chose not to participate"
-                    )
-            await asyncio.gather(*tasks)
+        participants = []
+        for user_association in group.users:
+            if user_association.participating:
+                participants.append(user_association.user)
+            else:
+                logger.debug(
+                    f"Skipping user {user_association.user} because they chose not to participate"
+                )
+
+        # One weight per member, straight out of the pool. This is at most a handful of block
+        # requests to the QRNG no matter how big the group is
+        weights = await entropy_pool.take(len(participants))
+        logger.debug(f"The quantuam random machine said {weights}")
+        weighted_set = list(zip(participants, weights))
 
         return {**pipe, "weighted_set": weighted_set}
 
@@ -228,42 +379,163 @@ def _make_pairs(pipe={}):
     weighted_set, group_id = pipe["weighted_set"], pipe["group_id"]
     with app.app_context():
         group = Group.query.filter_by(id=group_id).first()
-        final_pairs = []
-        pairs = [user for user, _ in sorted(weighted_set, key=lambda k: k[1])]
+        users = {user.id: user for user, _ in weighted_set}
 
-        pair_timestamp = datetime.now()
-        for index, giver in enumerate(pairs):
-            receiver = pairs[(index + 1) % len(pairs)]
-            new_pair = Pair(
-                group=group,
-                receiver=receiver,
-                giver=giver,
-                timestamp=pair_timestamp,
-                channel_id=str(uuid4()),
+        # Nobody should get the same person they got last round
+        last_round = Pair.query.filter(
+            and_(
+                Pair.group_id == group_id,
+                Pair.timestamp
+                == select(func.max(Pair.timestamp))
+                .where(Pair.group_id == group_id)
+                .scalar_subquery(),
+            )
+        ).all()
+        exclusions = {}
+        for pair in last_round:
+            exclusions.setdefault(pair.giver_id, set()).add(pair.receiver_id)
+
+        members = [user.id for user, _ in weighted_set]
+        weights = [weight for _, weight in weighted_set]
+        try:
+            try:
+                pairs = SingleCycle(members, weights, exclusions).solve()
+            except PairingInfeasible:
+                # Tiny groups (two people, say) can't avoid last round's pairs. Better the
+                # same santa again than no draw at all
+                logger.info(
+                    f"Last round's pairs can't all be avoided in group {group}. Ignoring them"
+                )
+                pairs = SingleCycle(members, weights).solve()
+        except PairingInfeasible as e:
+            return RetryException(f"Couldn't create pairs for group {group}: {e}")
+        except PairingSearchExhausted as e:
+            # The next draw gets new weights and so searches in a different order
+            return RetryException(
+                f"Couldn't find pairs for group {group} in time, please try again: {e}"
             )
 
-            final_pairs.append(giver.email)
+        pair_timestamp = datetime.now()
+        new_pairs = [
+            {
+                "group_id": group.id,
+                "giver_id": giver_id,
+                "receiver_id": receiver_id,
+                "timestamp": pair_timestamp,
+                "channel_id": uuid4(),
+                "emailed": False,
+            }
+            for giver_id, receiver_id in pairs
+        ]
+
+        # The whole draw goes in as one INSERT, and replaces the group's latest pairs,
+        # all in one transaction
+        Pair.bulk_save_to_db(db, new_pairs, commit=False)
+        LatestPair.replace_group(
+            db,
+            group.id,
+            [
+                {
+                    "group_id": group.id,
+                    "giver_id": pair["giver_id"],
+                    "receiver_id": pair["receiver_id"],
+                    "channel_id": pair["channel_id"],
+                    "giver_username": users[pair["giver_id"]].username,
+                    "receiver_username": users[pair["receiver_id"]].username,
+                    "group_name": group.name,
+                    "created_at": pair_timestamp,
+                }
+                for pair in new_pairs
+            ],
+        )
+        db.session.commit()
 
-            new_pair.save_to_db(db)
+        return pipe
 
-        return {**pipe, "final_pairs": final_pairs}
+
+# How many secret santa emails are in flight at once after a draw
+SANTA_EMAIL_CONCURRENCY = int(os.getenv("SANTA_EMAIL_CONCURRENCY", 20))
+
+
+def _send_secret_santa_email(giver_email, giver_first_name, group_name):
+    response = send_email(
+        to=[giver_email],
+        subject="You are someone's secret santa!!!",
+        template_name="secret_santa",
+        payload={
+            "group_name": group_name,
+            "santa_name": giver_first_name,
+            "url": "https://app.mysecretsanta.io/login?next=/santa",
+        },
+    )
+    if response is not None:
+        response.raise_for_status()
 
 
 @network_exception_retry
-def _send_secret_santa_email(giver_email, giver_first_name, group_id):
+def _send_secret_santa_emails(group_id):
+    """
+    Emails every giver of the group's latest draw who hasn't been emailed yet, SANTA_EMAIL_CONCURRENCY at a time.
+    Whoever got their email is marked in one UPDATE. If anybody didn't, we raise so the retry decorator reschedules
+    the task, and the next attempt only picks up the ones that are still left
+    """
     with app.app_context():
-        group = Group.query.filter_by(id=group_id).first()
-        send_email(
-            to=[giver_email],
-            subject="You are someone's secret santa!!!",
-            template_name="secret_santa",
-            payload={
-                "group_name": group.name,
-                "santa_name": giver_first_name,
-                "url": "https://app.mysecretsanta.io/login?next=/santa",
-            },
+        group = Group.query.get(group_id)
+        givers = (
+            db.session.query(Pair.id, User.email, User.first_name)
+            .join(User, User.id == Pair.giver_id)
+            .filter(
+                Pair.group_id == group_id,
+                Pair.timestamp
+                == select(func.max(Pair.timestamp))
+                .where(Pair.group_id == group_id)
+                .scalar_subquery(),
+                Pair.emailed.is_(False),
+            )
+            .all()
         )
 
+        def send(index):
+            giver = givers[index]
+            try:
+                _send_secret_santa_email(giver.email, giver.first_name, group.name)
+            except Exception as e:
+                return index, e
+            return index, None
+
+        # This runs on the gevent users worker, so fan out with greenlets instead of spinning up an event loop
+        result = FanOutResult(len(givers))
+        for index, error in Pool(SANTA_EMAIL_CONCURRENCY).imap_unordered(
+            send, range(len(givers))
+        ):
+            if error is None:
+                result.results[index] = True
+            else:
+                result.errors[index] = error
+
+        emailed = [givers[index].id for index in result.results]
+        if emailed:
+            Pair.query.filter(Pair.id.in_(emailed)).update(
+                {Pair.emailed: True}, synchronize_session=False
+            )
+            db.session.commit()
+
+        logger.info(f"Secret santa emails for group {group_id}: {result}")
+        if result.failed:
+            errors = list(result.errors.values())
+            # Anything that isn't a network hiccup won't get better by retrying
+            for error in errors:
+                if not isinstance(error, (*NETWORK_EXCEPTIONS, RateLimited)):
+                    raise error
+            # Sent everything the rate limits allowed. Pick the rest up once the buckets refill
+            if rate_limited := [e for e in errors if isinstance(e, RateLimited)]:
+                raise max(rate_limited, key=lambda e: e.wait)
+            raise ConnectionError(
+                f"{len(result.failed)} of {len(givers)} secret santa emails didn't go out: {errors[:3]}"
+            )
+
+        return {"emailed": len(emailed)}
+
 
 @network_exception_retry
 def _invite_user_to_sign_up(to_email, admin_first_name, group_name, invite_code):
@@ -322,25 +594,22 @@ def _send_message_notification(
 
 
 @network_exception_retry
-def _send_group_chat_notification(
-    receiver_email, sender_username, receiver_username, group_name, text, group_id
-):
+def _send_group_chat_notification_batch(recipients, text, group_id):
     with app.app_context():
         subject = "You have christmas mail from your group!"
-        intro = f"Hey @{receiver_username}, @{sender_username} sent a new message in the group chat! ({group_name})"
         if os.getenv("ENV") == "production":
-            send_email(
-                to=[receiver_email],
+            send_batch_email(
+                recipients=recipients,
                 subject=subject,
                 template_name="secret_santa_message_notification",
                 payload={
-                    "intro": intro,
                     "text": text,
                     "url": f"https://app.mysecretsanta.io/login?next=/groups?group_id={group_id}",
                 },
             )
         else:
-            logger.debug(intro)
+            for variables in recipients.values():
+                logger.debug(variables["intro"])
             logger.debug(text)
 
 
@@ -368,273 +637,174 @@ def _reset_user_password(email, user):
         else:
             logger.debug(new_password)
             # This is just to simulate network errors in a dev environemnt
-            requests.get("https://www.mysecretsanta.io/math")
+            http_client.get("https://www.mysecretsanta.io/math")
 
 
 @celery.task(name="user.send_group_chat_notifications")
-def send_group_chat_notifications(sender_username, text, group_id):
+@idempotent
+def send_group_chat_notifications(task_id):
     with app.app_context():
-        group = Group.query.filter_by(id=group_id).first()
+        _task = Task.query.get(task_id)
+        _task.mark_processing(db)
 
-        _task = (
-            Task.query.filter(
-                and_(
-                    Task.name == "send_group_chat_notifications",
-                    Task.payload["sender_username"].as_string() == sender_username,
-                    Task.payload["text"].as_string() == text,
-                    Task.payload["group_id"].as_integer() == group_id,
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
+        payload = _task.payload
+        sender_username = payload["sender_username"]
+        group = Group.query.get(payload["group_id"])
 
-        _task.status = "processing"
-        _task.save_to_db(db)
+        # Addresses that already got this message on an earlier attempt of this task
+        delivered = set(payload.get("delivered", []))
 
-        # TODO: @prithajnath Need a context manager to retry this block
-        error = None
-        try:
-            for user_association in group.users:
-                user = user_association.user
-                receiver_username = user.username
-                receiver_email = user.email
-                if sender_username != user.username:
-                    task = Task(
-                        name="send_group_chat_notification",
-                        started_at=datetime.now(),
-                        status="starting",
-                        payload={
-                            "receiver_email": receiver_email,
-                            "receiver_username": receiver_username,
-                            "sender_username": sender_username,
-                            "group_name": group.name,
-                            "text": text,
-                        },
-                    )
-
-                    task.save_to_db(db)
-
-                    app_celery.send_task(
-                        "user.send_group_chat_notification",
-                        (
-                            receiver_email,
-                            receiver_username,
-                            sender_username,
-                            group.name,
-                            text,
-                        ),
-                    )
-        except Exception as e:
-            error = str(e)
-
-        _task.status = "finished"
-        if error:
-            _task.error = error
-        _task.finished_at = datetime.now()
-        _task.save_to_db(db)
-
-
-@celery.task(name="user.send_group_chat_notification")
-def send_group_chat_notification(
-    receiver_email, receiver_username, sender_username, group_name, text
-):
-    with app.app_context():
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.name == "send_group_chat_notification",
-                    Task.payload["receiver_email"].as_string() == receiver_email,
-                    Task.payload["receiver_email"].as_string() == receiver_email,
-                    Task.payload["sender_username"].as_string() == sender_username,
-                    Task.payload["group_name"].as_string() == group_name,
-                    Task.payload["text"].as_string() == text,
-                    Task.status == "starting",
-                )
+        members = (
+            User.query.join(
+                GroupsAndUsersAssociation, GroupsAndUsersAssociation.user_id == User.id
             )
-            .order_by(Task.started_at.desc())
-            .first()
+            .filter(
+                GroupsAndUsersAssociation.group_id == group.id,
+                User.username != sender_username,
+            )
+            .with_entities(User.email, User.username)
+            .order_by(User.id)
+            .all()
         )
+        recipients = {
+            email: {
+                "intro": f"Hey @{username}, @{sender_username} sent a new message in the group chat! ({group.name})"
+            }
+            for email, username in members
+            if email not in delivered
+        }
+
+        emails = list(recipients)
+        result = None
+        for start in range(0, len(emails), MAILGUN_BATCH_SIZE):
+            batch = {
+                email: recipients[email]
+                for email in emails[start : start + MAILGUN_BATCH_SIZE]
+            }
+            result = _send_group_chat_notification_batch(
+                batch, payload["text"], group.id
+            )
+            if isinstance(result, RetryException):
+                break
 
-        task.status = "processing"
-        task.save_to_db(db)
-
-        group_id = Group.query.filter_by(name=group_name).first().id
-
-        result = _send_group_chat_notification(
-            receiver_email,
-            sender_username,
-            receiver_username,
-            group_name,
-            text,
-            group_id,
-        )
+            # One write per batch, so a retry only sends to whoever is left
+            delivered.update(batch)
+            _task.payload = {**_task.payload, "delivered": sorted(delivered)}
+            _task.save_to_db(db)
 
-        task.status = "finished"
-        if result:
-            task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        _task.mark_finished(db, error=result)
 
 
 @celery.task(name="user.send_message_notification")
-def send_message_notification(sender_id, receiver_id, channel_id, text, anonymous):
+@idempotent
+def send_message_notification(task_id):
     with app.app_context():
-        sender = User.query.filter_by(id=sender_id).first()
-        receiver = User.query.filter_by(id=receiver_id).first()
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
+
+        payload = task.payload
+        sender = User.query.filter_by(id=payload["sender_id"]).first()
+        receiver = User.query.filter_by(id=payload["receiver_id"]).first()
         group_name = (
-            all_latest_pairs_view.query.filter_by(channel_id=channel_id)
+            LatestPair.query.filter_by(channel_id=payload["channel_id"])
             .first()
             .group_name
         )
 
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.payload["sender_id"].as_integer() == sender_id,
-                    Task.payload["receiver_id"].as_integer() == receiver_id,
-                    Task.payload["channel_id"].as_string() == channel_id,
-                    Task.payload["text"].as_string() == text,
-                    Task.name == "send_message_notification",
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
-
-        task.status = "processing"
-        task.save_to_db(db)
-
         result = _send_message_notification(
             receiver.email,
             sender.username,
             receiver.username,
             group_name,
-            text,
-            anonymous,
+            payload["text"],
+            payload["anonymous"],
         )
 
-        task.status = "finished"
-        if result:
-            task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        task.mark_finished(db, error=result)
 
 
-@celery.task(name="user.send_secret_santa_email")
-def send_secret_santa_email(email, group_id):
+# Only waits on Mailgun, so it's routed to the users pool rather than taking a draw's slot
+@celery.task(name="user.send_secret_santa_emails")
+@idempotent
+def send_secret_santa_emails(task_id):
     with app.app_context():
-        user = User.query.filter_by(email=email).first()
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.payload["email"].as_string() == email,
-                    Task.name == "send_secret_santa_email",
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
-
-        task.status = "processing"
-        task.save_to_db(db)
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
 
-        result = _send_secret_santa_email(user.email, user.first_name, group_id)
+        result = _send_secret_santa_emails(task.payload["group_id"])
 
-        task.status = "finished"
-        task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        if isinstance(result, RetryException):
+            task.mark_finished(db, error=result)
+        else:
+            task.mark_finished(db)
 
 
 @celery.task(name="user.reset_password")
-def reset_user_password(email):
+@idempotent
+def reset_user_password(task_id):
     with app.app_context():
-        user = User.query.filter_by(email=email).first()
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.payload["email"].as_string() == email,
-                    Task.name == "reset_user_password",
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
-
-        task.status = "processing"
-        task.save_to_db(db)
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
 
+        email = task.payload["email"]
+        user = User.query.filter_by(email=email).first()
         result = _reset_user_password(email, user)
 
-        task.status = "finished"
-        task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        task.mark_finished(db, error=result)
 
 
 @celery.task(name="user.invite_user_to_group")
-def invite_user_to_group(to_email, admin_first_name, group_name):
+@idempotent
+def invite_user_to_group(task_id):
     with app.app_context():
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.payload["to_email"].as_string() == to_email,
-                    Task.payload["admin_first_name"].as_string() == admin_first_name,
-                    Task.payload["group_name"].as_string() == group_name,
-                    Task.name == "invite_user_to_group",
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
-
-        task.status = "processing"
-        task.save_to_db(db)
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
 
+        payload = task.payload
         result = _invite_user_to_group(
-            to_email, admin_first_name, group_name, task.payload["invite_code"]
+            payload["to_email"],
+            payload["admin_first_name"],
+            payload["group_name"],
+            payload["invite_code"],
         )
 
-        task.status = "finished"
-        task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        task.mark_finished(db, error=result)
 
 
 @celery.task(name="user.invite_user_to_sign_up")
-def invite_user_to_sign_up(to_email, admin_first_name, group_name):
+@idempotent
+def invite_user_to_sign_up(task_id):
     with app.app_context():
-        task = (
-            Task.query.filter(
-                and_(
-                    Task.payload["to_email"].as_string() == to_email,
-                    Task.payload["admin_first_name"].as_string() == admin_first_name,
-                    Task.payload["group_name"].as_string() == group_name,
-                    Task.name == "invite_user_to_sign_up",
-                    Task.status == "starting",
-                )
-            )
-            .order_by(Task.started_at.desc())
-            .first()
-        )
-
-        task.status = "processing"
-        task.save_to_db(db)
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
 
+        payload = task.payload
         result = _invite_user_to_sign_up(
-            to_email, admin_first_name, group_name, task.payload["invite_code"]
+            payload["to_email"],
+            payload["admin_first_name"],
+            payload["group_name"],
+            payload["invite_code"],
         )
 
-        task.status = "finished"
-        task.error = str(result)
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        task.mark_finished(db, error=result)
+
+
+@celery.task(name=REFRESH_TASK)
+def refresh_materialized_view(name):
+    with app.app_context():
+        refresh_scheduler.refresh(name)
+
+
+@celery.task(name="maintenance.maintain_task_partitions")
+def maintain_task_partitions():
+    with app.app_context():
+        task_partitions.maintain()
+
+
+@celery.task(name="maintenance.purge_idempotency_keys")
+def purge_idempotency_keys():
+    with app.app_context():
+        idempotency_keys.purge()
 
 
 def chain(*args, pipe={}):
@@ -652,50 +822,26 @@ def chain(*args, pipe={}):
 
 
 @celery.task(name="pair.create_pairs")
-def make_pairs(group_id):
+@idempotent
+def make_pairs(task_id):
     with app.app_context():
-        task = Task.query.filter(
-            and_(
-                Task.status == "starting",
-                Task.payload["group_id"].as_integer() == group_id,
-            )
-        ).first()
-
-        task.status = "processing"
-        task.save_to_db(db)
+        task = Task.query.get(task_id)
+        task.mark_processing(db)
 
-        for attempt in range(1000):
-            logger.info(f"Attempting to create pairs for {attempt + 1} time")
-            result = chain(_make_pairs_async, _make_pairs, pipe={"group_id": group_id})
-
-            if not isinstance(result, RetryException):
-                if not result["final_pairs"]:
-                    continue
-                else:
-                    break
-            else:
-                break
-        task.status = "finished"
-        task.finished_at = datetime.now()
-        task.save_to_db(db)
+        group_id = task.payload["group_id"]
+        result = chain(_make_pairs_async, _make_pairs, pipe={"group_id": group_id})
 
         # Update pair creation status
         if isinstance(result, RetryException):
-            task.error = str(result)
-            task.save_to_db(db)
+            task.mark_finished(db, error=result)
         else:
-            final_pairs = result["final_pairs"]
-            # Refresh materialzed view manually just to be safe
-            all_latest_pairs_view.refresh()
-
-            for giver in final_pairs:
-                send_email_task = Task(
-                    name="send_secret_santa_email",
-                    payload={"email": giver, "group_id": group_id},
-                    started_at=datetime.now(),
-                    status="starting",
-                )
-
-                send_email_task.save_to_db(db)
+            # One task emails the whole draw. It's committed along with the finished status
+            send_emails_task = Task(
+                name="send_secret_santa_emails",
+                payload={"group_id": group_id},
+                started_at=datetime.now(),
+                status="starting",
+            )
+            send_emails_task.enqueue(db.session, "user.send_secret_santa_emails")
 
-                app_celery.send_task("user.send_secret_santa_email", (giver, group_id))
+            task.mark_finished(db)
@@ -24,8 +24,11 @@ santatext
 
 docker-compose up --build -d
 
-while [ $(docker ps | grep dev-secret-santa | wc -l ) -ne "4" ]; do
-    sleep 5
+# Wait for every service in docker-compose.yml to be running, however many there are
+for service in $(docker-compose config --services); do
+    until [ "$(docker inspect -f '{{.State.Running}}' $(docker-compose ps -q $service) 2>/dev/null)" == "true" ]; do
+        sleep 5
+    done
 done
 
 container_name=dev-secret-santa-web
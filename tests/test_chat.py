@@ -0,0 +1,168 @@
+from unittest import mock
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import event
+
+from app import app, db
+from models import Group, GroupMessage, Pair, User
+
+
+@pytest.fixture
+def group_messages():
+    with app.app_context():
+        suffix = uuid4().hex[:8]
+        user = User(username=f"chat{suffix}", email=f"chat{suffix}@santa.io")
+        user.save_to_db(db)
+        group = Group(name=f"chat-{suffix}")
+        group.save_to_db(db)
+
+        GroupMessage.bulk_save_to_db(
+            db,
+            [
+                {"group_id": group.id, "sender_id": user.id, "text": str(i)}
+                for i in range(7)
+            ],
+        )
+        group_id, user_id = group.id, user.id
+        message_ids = [
+            message.id
+            for message in GroupMessage.query.filter_by(group_id=group_id).order_by(
+                GroupMessage.id
+            )
+        ]
+
+        yield group_id, message_ids
+
+        GroupMessage.query.filter_by(group_id=group_id).delete()
+        Group.query.get(group_id).delete_from_db(db)
+        User.query.get(user_id).delete_from_db(db)
+
+
+def page(group_id, **cursor):
+    messages, more = GroupMessage.page(
+        GroupMessage.query.filter_by(group_id=group_id), limit=3, **cursor
+    )
+    return [message.id for message in messages], more
+
+
+def test_first_page_is_the_newest_messages_oldest_first(group_messages):
+    group_id, ids = group_messages
+    with app.app_context():
+        assert page(group_id) == (ids[-3:], True)
+
+
+def test_before_walks_back_to_the_start(group_messages):
+    group_id, ids = group_messages
+    with app.app_context():
+        assert page(group_id, before=ids[-3]) == (ids[1:4], True)
+        assert page(group_id, before=ids[1]) == (ids[:1], False)
+
+
+def test_history_is_one_query_without_orm_objects(group_messages):
+    group_id, ids = group_messages
+    with app.app_context():
+        statements = []
+
+        def listener(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            messages, _ = GroupMessage.page(GroupMessage.history(group_id), limit=10)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+
+        assert len(statements) == 1
+        assert [message.id for message in messages] == ids
+        assert {message.username for message in messages} == {messages[0].username}
+        assert not any(isinstance(message, GroupMessage) for message in messages)
+
+
+def test_after_only_returns_newer_messages(group_messages):
+    group_id, ids = group_messages
+    with app.app_context():
+        assert page(group_id, after=ids[-1]) == ([], False)
+        assert page(group_id, after=ids[2]) == (ids[3:6], True)
+        assert page(group_id, after=ids[5]) == (ids[6:], False)
+
+
+@pytest.fixture
+def pair():
+    with app.app_context():
+        suffix = uuid4().hex[:8]
+        giver = User(username=f"giver{suffix}", email=f"giver{suffix}@santa.io")
+        receiver = User(username=f"recv{suffix}", email=f"recv{suffix}@santa.io")
+        giver.save_to_db(db)
+        receiver.save_to_db(db)
+        pair = Pair(giver_id=giver.id, receiver_id=receiver.id)
+        pair.save_to_db(db)
+
+        pair_id, giver_id, receiver_id = pair.id, giver.id, receiver.id
+        yield pair.channel_id, giver_id, receiver_id
+
+        Pair.query.get(pair_id).delete_from_db(db)
+        User.query.get(giver_id).delete_from_db(db)
+        User.query.get(receiver_id).delete_from_db(db)
+
+
+def test_channel_participants_are_looked_up_once(pair):
+    channel_id, giver_id, receiver_id = pair
+    with app.app_context():
+        assert Pair.participants(channel_id) == (giver_id, receiver_id)
+
+        with mock.patch.object(db.session, "query") as query:
+            assert Pair.participants(channel_id) == (giver_id, receiver_id)
+            query.assert_not_called()
+
+
+def test_unknown_channels_are_not_cached():
+    channel_id = uuid4()
+    with app.app_context():
+        with pytest.raises(LookupError):
+            Pair.participants(channel_id)
+
+        misses = Pair.participants.cache_info().misses
+        with pytest.raises(LookupError):
+            Pair.participants(channel_id)
+        assert Pair.participants.cache_info().misses == misses + 1
+
+
+@pytest.fixture
+def outsider():
+    with app.app_context():
+        suffix = uuid4().hex[:8]
+        user = User(username=f"out{suffix}", email=f"out{suffix}@santa.io")
+        user.save_to_db(db)
+        user_id = user.id
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+
+        yield client
+
+        User.query.get(user_id).delete_from_db(db)
+
+
+def test_chat_stream_is_only_for_group_members(group_messages, outsider):
+    group_id, _ = group_messages
+    response = outsider.get(f"/chat_stream?group_id={group_id}")
+    assert response.status_code == 404
+
+
+def test_chat_stream_is_only_for_the_pair(pair, outsider):
+    channel_id, _, _ = pair
+    response = outsider.get(f"/chat_stream?channel_id={channel_id}")
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("channel_id", [uuid4(), "not-a-uuid", None])
+def test_chat_stream_404s_for_unknown_channels(outsider, channel_id):
+    url = (
+        "/chat_stream"
+        if channel_id is None
+        else f"/chat_stream?channel_id={channel_id}"
+    )
+    assert outsider.get(url).status_code == 404
@@ -0,0 +1,70 @@
+import json
+
+import redis
+
+from lib.chat.stream import ChatStream
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, channel):
+        self.channels.append(channel)
+
+    def get_message(self, timeout):
+        return self.messages.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRedis:
+    def __init__(self, messages=()):
+        self.pubsubs = []
+        self.messages = messages
+        self.published = []
+
+    def pubsub(self, ignore_subscribe_messages):
+        self.pubsubs.append(FakePubSub(self.messages))
+        return self.pubsubs[-1]
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+def stream(fake):
+    stream = ChatStream(broker_url=None)
+    stream.redis = fake
+    return stream
+
+
+def test_published_messages_become_events_and_quiet_spells_keepalives():
+    fake = FakeRedis([None, {"data": b'{"id": 1}'}])
+    events = stream(fake).events("chat:group:1")
+
+    assert next(events).startswith("retry:")
+    assert next(events) == ": keepalive\n\n"
+    assert next(events) == 'data: {"id": 1}\n\n'
+
+    events.close()
+    assert fake.pubsubs[0].channels == ["chat:group:1"]
+    assert fake.pubsubs[0].closed
+
+
+def test_publish_serializes_to_json():
+    fake = FakeRedis()
+    chat = stream(fake)
+    chat.publish(chat.channel("group", 1), {"id": 1, "text": "hi"})
+
+    assert fake.published == [("chat:group:1", json.dumps({"id": 1, "text": "hi"}))]
+
+
+def test_publish_never_raises():
+    class DownRedis(FakeRedis):
+        def publish(self, channel, message):
+            raise redis.ConnectionError("down")
+
+    stream(DownRedis()).publish("chat:group:1", {"id": 1})
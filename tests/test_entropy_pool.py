@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from aiohttp.client_exceptions import ClientConnectionError
+
+from lib.entropy.pool import EntropyPool
+from lib.entropy.sources import LocalSource
+
+
+class CountingSource(LocalSource):
+    max_block_size = 100
+
+    def __init__(self):
+        self.calls = 0
+
+    async def fetch(self, count):
+        self.calls += 1
+        return await super().fetch(count)
+
+
+def test_large_draw_costs_a_handful_of_requests():
+    source = CountingSource()
+    pool = EntropyPool(source, capacity=500, low_watermark=0)
+
+    weights = asyncio.run(pool.take(1000))
+
+    assert len(weights) == 1000
+    assert source.calls == 10
+
+
+def test_leftovers_are_buffered_for_the_next_draw():
+    source = CountingSource()
+    pool = EntropyPool(source, capacity=500, low_watermark=0)
+
+    asyncio.run(pool.take(30))
+    assert len(pool) == 70
+
+    asyncio.run(pool.take(70))
+    assert source.calls == 1
+    assert len(pool) == 0
+
+
+def test_background_refill_tops_up_to_capacity():
+    source = CountingSource()
+    pool = EntropyPool(source, capacity=300, low_watermark=200)
+
+    asyncio.run(pool.take(10))
+    pool._refill_thread.join()
+
+    assert len(pool) == 300
+
+
+def test_partial_fetch_keeps_what_arrived_for_the_retry():
+    class FlakySource(CountingSource):
+        async def fetch(self, count):
+            self.calls += 1
+            if self.calls == 2:
+                raise ConnectionError("QRNG hiccup")
+            return await LocalSource.fetch(self, count)
+
+    source = FlakySource()
+    pool = EntropyPool(source, capacity=500, low_watermark=0)
+
+    with pytest.raises(ClientConnectionError):
+        asyncio.run(pool.take(300))
+    assert len(pool) == 200
+
+    assert len(asyncio.run(pool.take(300))) == 300
+    assert source.calls == 4
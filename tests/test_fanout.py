@@ -0,0 +1,53 @@
+import asyncio
+from functools import partial
+
+from lib.concurrency.fanout import fan_out
+
+
+def test_never_more_than_concurrency_calls_in_flight():
+    in_flight, peak = 0, 0
+
+    async def call(i):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return i
+
+    result = asyncio.run(fan_out([partial(call, i) for i in range(20)], concurrency=3))
+
+    assert peak == 3
+    assert result.complete
+    assert result.ordered_results() == list(range(20))
+
+
+def test_failures_and_timeouts_dont_sink_the_rest():
+    async def ok():
+        return "ok"
+
+    async def boom():
+        raise ValueError("boom")
+
+    async def slow():
+        await asyncio.sleep(5)
+
+    result = asyncio.run(fan_out([ok, boom, slow, ok], call_timeout=0.05))
+
+    assert result.results == {0: "ok", 3: "ok"}
+    assert isinstance(result.errors[1], ValueError)
+    assert result.timed_out == {2}
+    assert result.failed == {1, 2}
+
+
+def test_deadline_cancels_whatever_is_still_running():
+    async def slow():
+        await asyncio.sleep(5)
+
+    async def fast():
+        return 1
+
+    result = asyncio.run(fan_out([fast, slow, slow], deadline=0.05))
+
+    assert result.results == {0: 1}
+    assert result.timed_out == {1, 2}
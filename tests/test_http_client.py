@@ -0,0 +1,44 @@
+from unittest.mock import patch
+
+from lib.http.client import HTTPClient, _host_limits
+
+
+def test_session_is_reused_within_a_process():
+    client = HTTPClient()
+    assert client.session is client.session
+
+
+def test_session_is_rebuilt_after_a_fork():
+    client = HTTPClient()
+    session = client.session
+    client._pid = -1
+    assert client.session is not session
+
+
+def test_host_limits_get_their_own_pool():
+    client = HTTPClient(pool_maxsize=5, host_limits={"https://api.mailgun.net": 20})
+    session = client.session
+
+    mailgun = session.get_adapter("https://api.mailgun.net/v3/example/messages")
+    other = session.get_adapter("https://oauth2.googleapis.com/token")
+
+    assert mailgun._pool_maxsize == 20
+    assert other._pool_maxsize == 5
+
+
+def test_every_request_gets_a_timeout_unless_it_asks_for_one():
+    client = HTTPClient(connect_timeout=1, read_timeout=2)
+    with patch.object(client.session, "request") as request:
+        client.get("https://example.com")
+        client.post("https://example.com", timeout=30)
+
+    assert request.call_args_list[0].kwargs["timeout"] == (1, 2)
+    assert request.call_args_list[1].kwargs["timeout"] == 30
+
+
+def test_host_limits_from_env():
+    assert _host_limits("") == {}
+    assert _host_limits("https://api.mailgun.net=20, https://qrng.anu.edu.au=4") == {
+        "https://api.mailgun.net": 20,
+        "https://qrng.anu.edu.au": 4,
+    }
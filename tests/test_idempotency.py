@@ -0,0 +1,43 @@
+from uuid import uuid4
+
+import pytest
+
+from app import app
+from models import idempotency_keys
+
+
+@pytest.fixture
+def key():
+    with app.app_context():
+        key = f"test:{uuid4()}"
+        yield key
+        idempotency_keys.release(key)
+
+
+def test_only_the_first_claim_wins(key):
+    with app.app_context():
+        assert idempotency_keys.claim(key, "test")
+        assert not idempotency_keys.claim(key, "test")
+
+
+def test_released_keys_can_be_claimed_again(key):
+    with app.app_context():
+        assert idempotency_keys.claim(key, "test")
+        idempotency_keys.release(key)
+        assert idempotency_keys.claim(key, "test")
+
+
+def test_completed_keys_are_never_claimed_again(key):
+    with app.app_context():
+        assert idempotency_keys.claim(key, "test")
+        idempotency_keys.complete(key)
+        idempotency_keys.release(key)
+        assert not idempotency_keys.claim(key, "test")
+
+
+def test_suppressed_duplicates_are_counted(key):
+    with app.app_context():
+        before = idempotency_keys.suppressed().get("test", 0)
+        idempotency_keys.claim(key, "test")
+        idempotency_keys.claim(key, "test")
+        assert idempotency_keys.suppressed()["test"] == before + 1
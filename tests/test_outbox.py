@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+
+from app import app, db
+from sql.outbox import OutboxRelay
+
+
+class FakeCelery:
+    def __init__(self, on_send=None):
+        self.on_send = on_send
+        self.sent = []
+
+    @contextmanager
+    def producer_or_acquire(self):
+        yield None
+
+    def send_task(self, task_name, args, producer=None):
+        if self.on_send:
+            self.on_send()
+        self.sent.append((task_name, args))
+
+
+@pytest.fixture
+def table():
+    # A private copy of outbox, so neither real pending messages nor the running relay
+    # container get mixed up with the test's rows
+    with app.app_context():
+        table = f"outbox_test_{uuid4().hex[:8]}"
+        with db.engine.begin() as connection:
+            connection.execute(f"CREATE TABLE {table} (LIKE outbox INCLUDING ALL)")
+            for i in range(3):
+                connection.execute(
+                    text(
+                        f"INSERT INTO {table} (task_name, args, created_at) "
+                        "VALUES ('test.outbox', CAST(:args AS jsonb), now())"
+                    ),
+                    {"args": f"[{i}]"},
+                )
+
+        yield table
+
+        db.engine.execute(f"DROP TABLE {table}")
+
+
+def relay(table, celery):
+    return OutboxRelay(db, celery, table=table)
+
+
+def unsent(table):
+    return db.engine.execute(
+        f"SELECT count(*) FROM {table} WHERE sent_at IS NULL"
+    ).scalar()
+
+
+def test_batch_is_published_and_marked_sent(table):
+    with app.app_context():
+        celery = FakeCelery()
+        assert relay(table, celery).relay_batch() == 3
+
+        assert sorted(celery.sent) == [
+            ("test.outbox", (0,)),
+            ("test.outbox", (1,)),
+            ("test.outbox", (2,)),
+        ]
+        assert unsent(table) == 0
+
+
+def test_concurrent_relays_dont_publish_the_same_rows(table):
+    with app.app_context():
+        second = FakeCelery()
+        started = []
+
+        def relay_while_first_holds_its_batch():
+            # Runs inside the first relay's transaction, with its batch still locked
+            if not started:
+                started.append(True)
+                relay(table, second).relay_batch()
+
+        first = FakeCelery(on_send=relay_while_first_holds_its_batch)
+        relay(table, first).relay_batch()
+
+        assert len(first.sent) == 3
+        assert second.sent == []
+        assert unsent(table) == 0
+
+
+def test_failed_publish_leaves_rows_unsent(table):
+    with app.app_context():
+
+        def broker_down():
+            raise ConnectionError("broker down")
+
+        with pytest.raises(ConnectionError):
+            relay(table, FakeCelery(on_send=broker_down)).relay_batch()
+
+        assert unsent(table) == 3
+
+        celery = FakeCelery()
+        assert relay(table, celery).relay_batch() == 3
+        assert unsent(table) == 0
@@ -0,0 +1,84 @@
+from random import randint, sample
+
+import pytest
+
+from lib.pairing import cycle
+from lib.pairing.cycle import PairingInfeasible, PairingSearchExhausted, SingleCycle
+
+
+def assert_single_cycle(members, pairs):
+    givers = [giver for giver, _ in pairs]
+    receivers = [receiver for _, receiver in pairs]
+    assert sorted(givers) == sorted(members)
+    assert sorted(receivers) == sorted(members)
+
+    next_in_loop = dict(pairs)
+    current, seen = members[0], set()
+    while current not in seen:
+        seen.add(current)
+        current = next_in_loop[current]
+    assert len(seen) == len(members)
+
+
+def test_no_exclusions_follows_the_weights():
+    pairs = SingleCycle(members=[1, 2, 3], weights=[8231, 17, 40001]).solve()
+    assert pairs == [(2, 1), (1, 3), (3, 2)]
+
+
+def test_nobody_gets_last_rounds_receiver():
+    members = list(range(200))
+    last_round = sample(members, len(members))
+    exclusions = {
+        giver: {last_round[(index + 1) % len(members)]}
+        for index, giver in enumerate(last_round)
+    }
+    # Worst case: the weights put everyone back in last round's loop
+    weights = [last_round.index(member) for member in members]
+
+    pairs = SingleCycle(members, weights, exclusions).solve()
+
+    assert_single_cycle(members, pairs)
+    for giver, receiver in pairs:
+        assert receiver not in exclusions[giver]
+
+
+def test_large_group_with_a_few_exclusions_each():
+    members = list(range(10_000))
+    exclusions = {member: set(sample(members, 3)) for member in members}
+    weights = [randint(0, 2**16 - 1) for _ in members]
+
+    pairs = SingleCycle(members, weights, exclusions).solve()
+
+    assert_single_cycle(members, pairs)
+    for giver, receiver in pairs:
+        assert giver != receiver and receiver not in exclusions[giver]
+
+
+def test_three_people_have_exactly_one_other_loop():
+    exclusions = {"a": {"b"}, "b": {"c"}, "c": {"a"}}
+    pairs = SingleCycle(["a", "b", "c"], [1, 2, 3], exclusions).solve()
+    assert sorted(pairs) == [("a", "c"), ("b", "a"), ("c", "b")]
+
+
+def test_two_people_give_to_each_other():
+    pairs = SingleCycle(["a", "b"], [2, 1]).solve()
+    assert pairs == [("b", "a"), ("a", "b")]
+
+
+def test_infeasible_without_an_obviously_stuck_member():
+    # Everyone still has someone to give to, but a and b can only give to each other
+    exclusions = {"a": {"c", "d"}, "b": {"c", "d"}}
+    with pytest.raises(PairingInfeasible):
+        SingleCycle(["a", "b", "c", "d"], [4, 3, 2, 1], exclusions).solve()
+
+
+def test_lonely_member_cant_be_paired():
+    with pytest.raises(PairingInfeasible):
+        SingleCycle(["a"], [1]).solve()
+
+
+def test_giving_up_on_the_search_is_not_infeasible(monkeypatch):
+    monkeypatch.setattr(cycle, "MAX_SEARCH_STEPS", 1)
+    exclusions = {"a": {"c", "d"}, "b": {"c", "d"}}
+    with pytest.raises(PairingSearchExhausted):
+        SingleCycle(["a", "b", "c", "d"], [4, 3, 2, 1], exclusions).solve()
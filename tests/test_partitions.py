@@ -0,0 +1,36 @@
+from datetime import date
+
+from sql.partitions import MonthlyPartitions, add_months
+
+
+class FakePartitions(MonthlyPartitions):
+    def __init__(self, names, **kwargs):
+        super().__init__("tasks", conn=None, **kwargs)
+        self.names = names
+
+    def partitions(self):
+        return self.names
+
+
+def test_add_months_rolls_over_years():
+    assert add_months(date(2026, 11, 17), 1) == date(2026, 12, 1)
+    assert add_months(date(2026, 11, 17), 2) == date(2027, 1, 1)
+    assert add_months(date(2026, 1, 31), -1) == date(2025, 12, 1)
+    assert add_months(date(2026, 3, 1), -14) == date(2025, 1, 1)
+
+
+def test_partition_names_sort_by_month():
+    partitions = FakePartitions([])
+    assert partitions.partition_name(date(2026, 1, 1)) == "tasks_2026_01"
+    assert partitions.partition_name(date(2026, 10, 1)) == "tasks_2026_10"
+
+
+def test_only_partitions_past_retention_expire():
+    partitions = FakePartitions(
+        ["tasks_2025_12", "tasks_2026_03", "tasks_2026_04", "tasks_2026_10"],
+        retain=6,
+    )
+    assert partitions.expired(today=date(2026, 10, 18)) == [
+        "tasks_2025_12",
+        "tasks_2026_03",
+    ]
@@ -0,0 +1,46 @@
+import pytest
+
+from lib.ratelimit.token_bucket import EmailRateLimiter, RateLimited, TokenBuckets
+
+
+class FakeBuckets(TokenBuckets):
+    def __init__(self, wait=0):
+        super().__init__(broker_url=None)
+        self.wait = wait
+        self.calls = []
+
+    def acquire(self, buckets):
+        self.calls.append(buckets)
+        return self.wait
+
+
+def limiter(buckets):
+    return EmailRateLimiter(
+        buckets,
+        provider="mailgun",
+        provider_rate=50,
+        provider_burst=100,
+        domain_rate=20,
+        domain_burst=1000,
+    )
+
+
+def test_one_provider_token_per_call_and_one_domain_token_per_recipient():
+    buckets = FakeBuckets()
+    limiter(buckets).check(["a@gmail.com", "b@GMAIL.com", "c@santa.io"])
+
+    assert buckets.calls == [
+        {
+            "mailgun": (50, 100, 1),
+            "mailgun:domain:gmail.com": (20, 1000, 2),
+            "mailgun:domain:santa.io": (20, 1000, 1),
+        }
+    ]
+
+
+def test_waiting_raises_with_how_long():
+    with pytest.raises(RateLimited) as e:
+        limiter(FakeBuckets(wait=1.5)).check(["a@gmail.com"])
+
+    assert e.value.wait == 1.5
+    assert "mailgun:domain:gmail.com" in e.value.buckets